@@ -0,0 +1,301 @@
+# nxt.asyncbrick module -- Non-blocking access to LEGO Mindstorms NXT bricks
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to drive many bricks from one thread. An AsyncBrick wraps a connected
+Brick and has the same opcode methods, but they return immediately with a
+nxt.utils.Future instead of waiting for the reply:
+
+    loop = EventLoop()
+    bricks = [AsyncBrick(b, loop) for b in connected_bricks]
+    futures = [b.get_battery_level() for b in bricks]
+    levels = [f.result(timeout=1) for f in futures]
+
+Bluetooth connections are multiplexed by the single thread of an EventLoop,
+which waits on all of their sockets at once, with up to the pipeline_depth
+of the socket commands outstanding. USB and Fantom connections can't be
+waited on that way, and server (IpSock) replies carry no length with which
+to tell merged replies apart, so each of those gets a worker thread which
+sends one command at a time instead.
+While an AsyncBrick is in use, don't call the blocking methods of the
+Brick it wraps from other threads: replies are matched to requests in the
+order they were sent.
+"""
+
+import select
+import socket
+from collections import deque
+from itertools import count
+from threading import Lock, Thread
+from time import sleep
+from Queue import Queue
+
+from nxt.brick import _Meta, _set_reply
+from nxt.telegram import Telegram
+from nxt.utils import Future
+from nxt.bluesock import BlueSock
+
+# Numbers the worker threads of _ThreadTransport
+_thread_ids = count(1)
+
+
+class EventLoop(object):
+    """Runs one thread which waits for replies on the sockets of any number of
+    AsyncBricks, parses them and completes the matching futures. Callbacks
+    added to those futures run in this thread, so they should not block.
+    poll_interval is how often (in seconds) the thread notices newly added
+    connections and stop requests.
+    """
+    def __init__(self, poll_interval=0.05):
+        self.poll_interval = poll_interval
+        self._transports = {}
+        self._lock = Lock()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = Thread(target=self._run, name='nxt-event-loop')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add(self, transport):
+        with self._lock:
+            self._transports[transport.fileno()] = transport
+        self.start()
+
+    def remove(self, transport):
+        with self._lock:
+            for fd, t in self._transports.items():
+                if t is transport:
+                    del self._transports[fd]
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                transports = dict(self._transports)
+            if not transports:
+                sleep(self.poll_interval)
+                continue
+            try:
+                readable = select.select(transports.keys(), [], [],
+                    self.poll_interval)[0]
+            except (select.error, socket.error, ValueError):
+                # a socket was closed under us; find out which one
+                readable = []
+                for fd, transport in transports.items():
+                    try:
+                        select.select([fd], [], [], 0)
+                    except (select.error, socket.error, ValueError), err:
+                        self.remove(transport)
+                        transport.fail(err)
+            for fd in readable:
+                transport = transports[fd]
+                try:
+                    transport.on_readable()
+                except (socket.error, IOError, EOFError), err:
+                    self.remove(transport)
+                    transport.fail(err)
+
+
+_default_loop = None
+
+def get_event_loop():
+    'Returns the EventLoop used by AsyncBricks created without one'
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
+
+
+def _finish_all(finished):
+    for future, result, exception in finished:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+def _complete(future, opcode, parse_func, pkt):
+    try:
+        result = parse_func(Telegram(opcode=opcode, pkt=pkt))
+    except Exception, err:
+        future.set_exception(err)
+    else:
+        future.set_result(result)
+
+
+class _StreamTransport(object):
+    """Sends telegrams from the calling thread and lets an EventLoop read the
+    replies, which arrive preceded by their 2 byte length (Bluetooth). At
+    most the pipeline_depth of the socket telegrams wait for a reply at a
+    time; later ones are held back and sent as replies come in.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.depth = max(1, getattr(sock, 'pipeline_depth', 1))
+        self._pending = deque()
+        self._backlog = deque()
+        self._buffer = ''
+        self._lock = Lock()
+
+    def fileno(self):
+        return self.sock.sock.fileno()
+
+    def submit(self, opcode, ogram, parse_func):
+        future = Future()
+        with self._lock:
+            self._backlog.append((opcode, ogram, parse_func, future))
+            finished = self._fill()
+        _finish_all(finished)
+        return future
+
+    def _fill(self):
+        """Sends backlogged telegrams while there is room in the pipeline.
+        Returns the (future, result, exception) of the ones which are done,
+        to be completed once self._lock is released. Call with it held.
+        """
+        finished = []
+        while self._backlog and len(self._pending) < self.depth:
+            opcode, ogram, parse_func, future = self._backlog.popleft()
+            try:
+                self.sock.send(str(ogram))
+            except Exception, err:
+                finished.append((future, None, err))
+                continue
+            if ogram.reply:
+                self._pending.append((opcode, parse_func, future))
+            else:
+                finished.append((future, None, None))
+        return finished
+
+    def on_readable(self):
+        data = self.sock.sock.recv(4096)
+        if not data:
+            raise EOFError('Connection closed by the NXT')
+        self._buffer += data
+        while len(self._buffer) >= 2:
+            plen = ord(self._buffer[0]) + (ord(self._buffer[1]) << 8)
+            if len(self._buffer) < plen + 2:
+                break
+            pkt = self._buffer[2:plen + 2]
+            self._buffer = self._buffer[plen + 2:]
+            self._dispatch(pkt)
+
+    def _dispatch(self, pkt):
+        with self._lock:
+            if not self._pending:
+                return # unsolicited data, nobody is waiting for it
+            opcode, parse_func, future = self._pending.popleft()
+            finished = self._fill()
+        _complete(future, opcode, parse_func, pkt)
+        _finish_all(finished)
+
+    def fail(self, err):
+        with self._lock:
+            pending, self._pending = self._pending, deque()
+            backlog, self._backlog = self._backlog, deque()
+        for opcode, parse_func, future in pending:
+            future.set_exception(err)
+        for opcode, ogram, parse_func, future in backlog:
+            future.set_exception(err)
+
+    def close(self, loop):
+        loop.remove(self)
+        self.fail(EOFError('AsyncBrick closed'))
+
+
+class _ThreadTransport(object):
+    """Offloads the blocking send/recv of a socket which can't be waited on
+    with select (such as USBSock) to a worker thread.
+    """
+    def __init__(self, brick):
+        self.brick = brick
+        self._queue = Queue()
+        thread = Thread(target=self._run, name='nxt-io-%d' % next(_thread_ids))
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, opcode, ogram, parse_func):
+        future = Future()
+        self._queue.put((opcode, ogram, parse_func, future))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            opcode, ogram, parse_func, future = item
+            try:
+                with self.brick.lock:
+                    self.brick.sock.send(str(ogram))
+                    if ogram.reply:
+                        pkt = self.brick.sock.recv()
+            except Exception, err:
+                future.set_exception(err)
+                continue
+            if ogram.reply:
+                _complete(future, opcode, parse_func, pkt)
+            else:
+                future.set_result(None)
+
+    def close(self, loop):
+        self._queue.put(None)
+
+
+def _make_submitter(opcode, poll_func, parse_func):
+    def submit(self, *args, **kwargs):
+        reply = kwargs.pop('reply', None)
+        ogram = poll_func(opcode, *args, **kwargs)
+        _set_reply(self.brick, opcode, ogram, reply)
+        return self._transport.submit(opcode, ogram, parse_func)
+    return submit
+
+class _AsyncMeta(_Meta):
+    'Metaclass which adds one future-returning method for each opcode'
+
+    make_method = staticmethod(_make_submitter)
+
+
+class AsyncBrick(object):
+    """Non-blocking counterpart of Brick. brick must already be connected;
+    loop is the EventLoop to use (get_event_loop() by default).
+    """
+
+    __metaclass__ = _AsyncMeta
+
+    def __init__(self, brick, loop=None):
+        self.brick = brick
+        if loop is None:
+            loop = get_event_loop()
+        self.loop = loop
+        if isinstance(brick.sock, BlueSock):
+            self._transport = _StreamTransport(brick.sock)
+            loop.add(self._transport)
+        else:
+            self._transport = _ThreadTransport(brick)
+
+    def detach(self):
+        """Stops handling replies for this brick. Commands still waiting for
+        a reply fail. The underlying Brick is left connected. (This can't be
+        called close(), which is the method for the file close opcode.)
+        """
+        self._transport.close(self.loop)
@@ -0,0 +1,280 @@
+# nxt.benchmark module -- Throughput and latency measurements of NXT links
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to measure how fast nxt-python talks to a brick, on a real link or on
+a simulated one (see nxt.simsock), and to track it between versions:
+
+    python -m nxt.benchmark --link sim-bluetooth --json before.json
+
+measures per opcode round trip times, commands per second (one by one and
+pipelined), the Python CPU time per command split into building, parsing and
+transport, i2c sensor samples per second, file upload speed and (on request)
+brick discovery time. run() returns the same results as a dictionary.
+"""
+
+import json
+import platform
+import sys
+from optparse import OptionParser
+from time import clock, time
+
+from nxt.latency import measure
+from nxt.telegram import OPCODES, Telegram
+from nxt.motor import PORT_A
+from nxt.sensor import PORT_1, PORT_2, PORT_3
+
+# (method, arguments) of the commands measured; they don't change anything
+# on the brick
+COMMANDS = [
+    ('keep_alive', ()),
+    ('get_battery_level', ()),
+    ('get_output_state', (PORT_A, )),
+    ('get_input_values', (PORT_1, )),
+    ('get_firmware_version', ()),
+    ('get_device_info', ()),
+]
+
+BENCHMARK_FILE = 'benchmark.dat'
+
+_OPCODE_BY_NAME = dict((OPCODES[opcode][0].__name__, opcode)
+                       for opcode in OPCODES)
+
+
+def _profile_dict(profile):
+    return {'min': profile.min, 'mean': profile.mean, 'p50': profile.p50,
+            'p99': profile.p99, 'max': profile.max,
+            'samples': len(profile.samples)}
+
+
+def bench_latency(brick, samples=50):
+    'Returns the round trip time statistics (seconds) of every command'
+    results = {}
+    for name, args in COMMANDS:
+        results[name] = _profile_dict(measure(getattr(brick, name), samples,
+                                              *args))
+    return results
+
+
+def bench_throughput(brick, count=200, command=COMMANDS[1]):
+    """Returns how many commands per second are done one by one, and in
+    pipelined batches (see Brick.batch).
+    """
+    name, args = command
+    method = getattr(brick, name)
+    started = time()
+    for n in range(count):
+        method(*args)
+    serial = count / (time() - started)
+    started = time()
+    batch = brick.batch()
+    for n in range(count):
+        getattr(batch, name)(*args)
+    batch.execute()
+    batched = count / (time() - started)
+    return {'command': name, 'serial_per_second': serial,
+            'batched_per_second': batched}
+
+
+def bench_cpu(brick, count=500):
+    """Returns the Python CPU time (seconds) per command spent building the
+    telegram, parsing the reply and in the rest of the round trip (the
+    socket and Brick code).
+    """
+    results = {}
+    for name, args in COMMANDS:
+        opcode = _OPCODE_BY_NAME[name]
+        poll_func, parse_func = OPCODES[opcode][:2]
+        ogram = poll_func(opcode, *args)
+        with brick.lock:
+            brick.sock.send(str(ogram))
+            pkt = brick.sock.recv()
+        started = clock()
+        for n in range(count):
+            str(poll_func(opcode, *args))
+        build = (clock() - started) / count
+        started = clock()
+        for n in range(count):
+            parse_func(Telegram(opcode=opcode, pkt=pkt))
+        parse = (clock() - started) / count
+        method = getattr(brick, name)
+        started = clock()
+        for n in range(count):
+            method(*args)
+        total = (clock() - started) / count
+        results[name] = {'build': build, 'parse': parse,
+                         'transport': max(0, total - build - parse),
+                         'total': total}
+    return results
+
+
+def bench_i2c(brick, sensors, duration=1.0):
+    """Returns the samples per second read from each of the given
+    (name, sensor, method name) digital sensors, each read alone for about
+    duration seconds.
+    """
+    results = {}
+    for name, sensor, method in sensors:
+        read = getattr(sensor, method)
+        count = 0
+        started = time()
+        while time() - started < duration:
+            read()
+            count += 1
+        results[name] = count / (time() - started)
+    return results
+
+
+def bench_upload(brick, size=16 * 1024, fname=BENCHMARK_FILE):
+    """Returns the upload and download speed (KB/s) of a size byte file,
+    which is deleted afterwards. It must not exist yet.
+    """
+    data = ''.join(chr(n & 0xFF) for n in range(size))
+    started = time()
+    brick.upload(fname, data, verify=False)
+    upload = size / 1024.0 / (time() - started)
+    try:
+        started = time()
+        copy = brick.download(fname)
+        download = size / 1024.0 / (time() - started)
+    finally:
+        brick.delete(fname)
+    if copy != data:
+        raise ValueError('Downloaded file differs from the uploaded one')
+    return {'bytes': size, 'upload_kb_per_second': upload,
+            'download_kb_per_second': download}
+
+
+def bench_discovery(method=None):
+    'Returns how long finding bricks takes (seconds), one search at a time'
+    from nxt.locator import find_bricks, find_all_bricks_parallel, Method
+    if method is None:
+        method = Method()
+    started = time()
+    found = 0
+    for sock in find_bricks(silent=True, method=method):
+        found += 1
+    sequential = time() - started
+    started = time()
+    bricks = find_all_bricks_parallel(silent=True, method=method)
+    parallel = time() - started
+    return {'found': found, 'find_bricks': sequential,
+            'find_all_bricks_parallel': parallel,
+            'connected': len(set(id(b) for b in bricks.values()))}
+
+
+def _sim_i2c_sensors(brick):
+    from nxt.sensor.generic import Ultrasonic
+    from nxt.sensor.hitechnic import Compass
+    from nxt.simsock import SimI2CDevice
+    sim = brick.sock.sim
+    sim.add_i2c_device(PORT_2)
+    compass = SimI2CDevice('V1.23', 'HiTechnc', 'Compass ')
+    sim.add_i2c_device(PORT_3, compass)
+    return [('Ultrasonic', Ultrasonic(brick, PORT_2), 'get_sample'),
+            ('HTCompass', Compass(brick, PORT_3), 'get_sample')]
+
+
+def run(brick, samples=50, count=200, sensors=(), files=False,
+        discovery=False):
+    """Runs the benchmarks on brick and returns the results. sensors is a
+    list of (name, sensor, method name) for bench_i2c; files enables the
+    upload benchmark, which writes to the brick's flash; discovery the
+    search for bricks.
+    """
+    results = {
+        'link': getattr(brick.sock, 'type', None),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time(),
+        'latency': bench_latency(brick, samples),
+        'throughput': bench_throughput(brick, count),
+        'cpu': bench_cpu(brick, count),
+    }
+    if sensors:
+        results['i2c'] = bench_i2c(brick, sensors)
+    if files:
+        results['upload'] = bench_upload(brick)
+    if discovery:
+        results['discovery'] = bench_discovery()
+    return results
+
+
+def _print_results(results):
+    print 'Link: %s (Python %s)' % (results['link'], results['python'])
+    print 'Round trip times (ms):'
+    for name, args in COMMANDS:
+        profile = results['latency'][name]
+        print '  %-22s p50 %7.2f  p99 %7.2f' % (name, profile['p50'] * 1000,
+                                               profile['p99'] * 1000)
+    throughput = results['throughput']
+    print '%s per second: %.0f one by one, %.0f batched' % (
+        throughput['command'], throughput['serial_per_second'],
+        throughput['batched_per_second'])
+    print 'CPU time per command (us): build / parse / transport'
+    for name, args in COMMANDS:
+        cpu = results['cpu'][name]
+        print '  %-22s %6.1f / %6.1f / %6.1f' % (name, cpu['build'] * 1e6,
+            cpu['parse'] * 1e6, cpu['transport'] * 1e6)
+    for name, rate in sorted(results.get('i2c', {}).items()):
+        print 'i2c %s: %.1f samples per second' % (name, rate)
+    if 'upload' in results:
+        upload = results['upload']
+        print 'Files: upload %.1f KB/s, download %.1f KB/s' % (
+            upload['upload_kb_per_second'], upload['download_kb_per_second'])
+    if 'discovery' in results:
+        discovery = results['discovery']
+        print 'Discovery: %d found in %.2f s, %.2f s in parallel' % (
+            discovery['found'], discovery['find_bricks'],
+            discovery['find_all_bricks_parallel'])
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--link', default='sim-usb', help='sim-usb, '
+        'sim-bluetooth or sim-instant for a simulated brick, or brick to '
+        'use the one found by nxt.locator (default: %default)')
+    parser.add_option('--samples', type='int', default=50,
+        help='round trips measured per command (default: %default)')
+    parser.add_option('--count', type='int', default=200,
+        help='commands per throughput and CPU run (default: %default)')
+    parser.add_option('--files', action='store_true', default=None,
+        help='measure uploads (always on for simulated bricks)')
+    parser.add_option('--discovery', action='store_true', default=False,
+        help='measure the search for bricks')
+    parser.add_option('--json', metavar='FILE',
+        help='write the results to FILE, or to stdout if FILE is -')
+    options, args = parser.parse_args(argv[1:])
+    sensors = []
+    if options.link.startswith('sim-'):
+        from nxt.simsock import SimSock
+        brick = SimSock(options.link[4:], seed=0).connect()
+        sensors = _sim_i2c_sensors(brick)
+        files = True
+    elif options.link == 'brick':
+        from nxt.locator import find_one_brick
+        brick = find_one_brick(silent=True)
+        files = bool(options.files)
+    else:
+        parser.error('Unknown link %s' % options.link)
+    results = run(brick, options.samples, options.count, sensors, files,
+                  options.discovery)
+    if options.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+        return
+    _print_results(results)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ class BlueSock(object):
 
     bsize = 118  # Bluetooth socket block size
     PORT = 1     # Standard NXT rfcomm port
+    pipeline_depth = 4  # replies which may be outstanding in a Batch
 
     type = 'bluetooth'
 
@@ -13,34 +13,141 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from time import sleep
-from threading import Lock
-from nxt.error import FileNotFound, ModuleNotFound
+from time import sleep, time
+from threading import Thread
+from nxt.error import FileNotFound, ModuleNotFound, SysProtError
 from nxt.telegram import OPCODES, Telegram
+from nxt.direct import NO_REPLY_OPCODES, _OUTPUT_STATE
+from nxt.instrument import Instrument, BrickLock, URGENT, NORMAL, BULK
 from nxt.sensor import get_sensor
+from nxt.sensor.digital import I2CScheduler
 from nxt.motcont import MotCont
+from nxt.motor import MODE_BRAKE, RUN_STATE_IDLE
+
+# Used for sockets which don't declare a block size. It keeps both write
+# telegrams and read replies within a 64 byte USB packet.
+DEFAULT_BSIZE = 58
+
+# How many blocks of a file are sent in one Batch before the progress
+# callback is called.
+BLOCKS_PER_BATCH = 16
+
+# Files which the firmware uses straight from flash must be contiguous there
+LINEAR_EXTENSIONS = ('.rxe', '.rpg', '.rtm', '.ric', '.rso')
+
+# BrickLock priority of each opcode, NORMAL if not listed. Stopping
+# programs and sounds goes ahead of other waiting commands, file transfers
+# after them. set_output_state is URGENT only when it stops the motors (see
+# get_priority). The Brick methods take priority= to override this per call.
+PRIORITIES = {
+    0x01: URGENT, # stop_program
+    0x0C: URGENT, # stop_sound_playback
+    0x82: BULK, # read
+    0x83: BULK, # write
+}
+
+def get_priority(opcode, ogram):
+    """Returns the BrickLock priority of the telegram ogram: URGENT for a
+    set_output_state which stops the motors (power 0, and idle or braking),
+    else the one in PRIORITIES.
+    """
+    if opcode == 0x04:
+        (port, power, mode, regulation, turn_ratio, run_state,
+            tacho_limit) = _OUTPUT_STATE.unpack_from(str(ogram), 2)
+        if power == 0 and (run_state == RUN_STATE_IDLE or mode & MODE_BRAKE):
+            return URGENT
+    return PRIORITIES.get(opcode, NORMAL)
+
+class ReplyPolicy(object):
+    """Decides which commands a Brick sends without asking for a reply. Set
+    brick.reply_policy to one to skip the wait for the acknowledgement of the
+    given opcodes (by default all of NO_REPLY_OPCODES). Errors of commands
+    sent that way go unnoticed, so if check_every is N > 0, every Nth of them
+    still asks for a reply, which makes a failing command stream raise within
+    N calls.
+    """
+    def __init__(self, opcodes=NO_REPLY_OPCODES, check_every=0):
+        unknown = set(opcodes) - NO_REPLY_OPCODES
+        if unknown:
+            raise ValueError('Opcodes %s need a reply' % sorted(unknown))
+        self.opcodes = frozenset(opcodes)
+        self.check_every = check_every
+        self._count = 0
+
+    def want_reply(self, opcode):
+        if opcode not in self.opcodes:
+            return None
+        if self.check_every:
+            self._count = (self._count + 1) % self.check_every
+            if self._count == 0:
+                return True
+        return False
+
+
+def _set_reply(brick, opcode, ogram, reply):
+    """Applies a reply= argument, or else the reply_policy of brick, to an
+    outgoing telegram.
+    """
+    if reply is None and brick.reply_policy is not None:
+        reply = brick.reply_policy.want_reply(opcode)
+    if reply is not None and bool(reply) != ogram.reply:
+        if opcode not in NO_REPLY_OPCODES:
+            raise ValueError('Opcode 0x%02X needs a reply' % opcode)
+        ogram.set_reply(reply)
 
 def _make_poller(opcode, poll_func, parse_func):
     def poll(self, *args, **kwargs):
+        reply = kwargs.pop('reply', None)
+        priority = kwargs.pop('priority', None)
         ogram = poll_func(opcode, *args, **kwargs)
-        with self.lock:
-            self.sock.send(str(ogram))
+        _set_reply(self, opcode, ogram, reply)
+        if priority is None:
+            priority = get_priority(opcode, ogram)
+        if self.io is not None:
+            return self.io.submit(opcode, ogram, parse_func,
+                                  priority).result()
+        pkt = str(ogram)
+        ipkt = ''
+        waited = sent = time()
+        try:
+            with self.lock.hold(poll_func.__name__, priority):
+                sent = time()
+                self.sock.send(pkt)
+                if ogram.reply:
+                    ipkt = self.sock.recv()
             if ogram.reply:
-                igram = Telegram(opcode=opcode, pkt=self.sock.recv())
-        if ogram.reply:
-            return parse_func(igram)
-        else:
-            return None
+                result = parse_func(Telegram(opcode=opcode, pkt=ipkt))
+            else:
+                result = None
+        except Exception, err:
+            if self.instrument is not None:
+                self.instrument.record(opcode, len(pkt), len(ipkt),
+                                       sent - waited, time() - sent, err)
+            raise
+        if self.instrument is not None:
+            self.instrument.record(opcode, len(pkt), len(ipkt),
+                                   sent - waited, time() - sent)
+        return result
     return poll
 
+def _make_queuer(opcode, poll_func, parse_func):
+    def queue(self, *args, **kwargs):
+        reply = kwargs.pop('reply', None)
+        ogram = poll_func(opcode, *args, **kwargs)
+        _set_reply(self.brick, opcode, ogram, reply)
+        self._queue.append((opcode, ogram, parse_func))
+    return queue
+
 class _Meta(type):
     'Metaclass which adds one method for each telegram opcode'
 
+    make_method = staticmethod(_make_poller)
+
     def __init__(cls, name, bases, dict):
         super(_Meta, cls).__init__(name, bases, dict)
         for opcode in OPCODES:
             poll_func, parse_func = OPCODES[opcode][0:2]
-            m = _make_poller(opcode, poll_func, parse_func)
+            m = type(cls).make_method(opcode, poll_func, parse_func)
             try:
                 m.__doc__ = OPCODES[opcode][2]
             except:
@@ -48,6 +155,138 @@ class _Meta(type):
             setattr(cls, poll_func.__name__, m)
 
 
+class _BatchMeta(_Meta):
+    'Metaclass which adds one queueing method for each telegram opcode'
+
+    make_method = staticmethod(_make_queuer)
+
+
+class Batch(object):
+    """Queues commands for a NXT brick and sends them back-to-back, so that
+    the brick is not waited on once per command. It has one method for each
+    telegram opcode, like Brick, but those only queue the command. Use it as
+    a context manager:
+
+        with brick.batch() as batch:
+            batch.get_input_values(PORT_1)
+            batch.get_output_state(PORT_A)
+        values, state = batch.results
+
+    or call execute() directly. Results are in the order the commands were
+    queued, with None for commands which were sent without requesting a
+    reply. window is the maximum number of replies which may be outstanding
+    at a time; it defaults to the pipeline_depth of the brick's socket (1,
+    i.e. no pipelining, for sockets which don't declare one). priority is
+    the BrickLock priority of the whole batch; by default the most urgent
+    one of its commands (see get_priority).
+    """
+
+    __metaclass__ = _BatchMeta
+
+    def __init__(self, brick, window=None, priority=None):
+        self.brick = brick
+        if window is None:
+            window = getattr(brick.sock, 'pipeline_depth', 1)
+        self.window = max(1, window)
+        self.priority = priority
+        self.results = None
+        self._queue = []
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etp, value, tb):
+        if etp is None:
+            self.execute()
+        else:
+            self._queue = []
+
+    def execute(self):
+        """Sends all queued commands and returns the list of parsed replies.
+        If any reply reports an error, all replies are still read (so the link
+        stays in sync) and the first error is raised afterwards; in that case
+        self.results holds the exception objects in place of the failed
+        commands' results.
+        """
+        queue, self._queue = self._queue, []
+        if self.brick.io is not None:
+            return self._execute_queued(queue)
+        pkts = [None] * len(queue)
+        sizes = [0] * len(queue)
+        times = [0.0] * len(queue)
+        pending = []
+        sock = self.brick.sock
+        priority = self.priority
+        if priority is None:
+            priority = min([get_priority(opcode, ogram)
+                            for opcode, ogram, parse_func in queue] or
+                           [NORMAL])
+        waited = time()
+        with self.brick.lock.hold('batch', priority):
+            lock_wait = time() - waited
+            for i, (opcode, ogram, parse_func) in enumerate(queue):
+                if len(pending) >= self.window:
+                    j = pending.pop(0)
+                    pkts[j] = sock.recv()
+                    times[j] = time() - times[j]
+                pkt = str(ogram)
+                sizes[i] = len(pkt)
+                times[i] = time()
+                sock.send(pkt)
+                if ogram.reply:
+                    pending.append(i)
+                else:
+                    times[i] = time() - times[i]
+            for i in pending:
+                pkts[i] = sock.recv()
+                times[i] = time() - times[i]
+        results = []
+        error = None
+        instrument = self.brick.instrument
+        for i, ((opcode, ogram, parse_func), pkt) in enumerate(zip(queue,
+                                                                   pkts)):
+            err = None
+            if pkt is None:
+                results.append(None)
+            else:
+                try:
+                    results.append(parse_func(Telegram(opcode=opcode,
+                                                       pkt=pkt)))
+                except Exception, err:
+                    results.append(err)
+                    if error is None:
+                        error = err
+            if instrument is not None:
+                # the batch waited for the lock once, on its first command
+                instrument.record(opcode, sizes[i], len(pkt or ''),
+                                  lock_wait if i == 0 else 0.0, times[i], err)
+        self.results = results
+        if error is not None:
+            raise error
+        return results
+
+    def _execute_queued(self, queue):
+        'Hands the commands to the IOThread of the brick instead'
+        futures = self.brick.io.submit_batch(queue, self.priority)
+        results = []
+        error = None
+        for future in futures:
+            err = future.exception()
+            if err is None:
+                results.append(future.result())
+            else:
+                results.append(err)
+                if error is None:
+                    error = err
+        self.results = results
+        if error is not None:
+            raise error
+        return results
+
+
 class FileFinder(object):
     'A generator to find files on a NXT brick.'
 
@@ -94,26 +333,50 @@ def File(brick, name, mode='r', size=None):
         return ValueError('Mode ' + str(mode) + ' not supported')
 
 
+def _bsize(brick):
+    return getattr(brick.sock, 'bsize', DEFAULT_BSIZE)
+
+
 class FileReader(object):
     """Context manager to read a file on a NXT brick. Do use the iterator or
     the read() method, but not both at the same time!
     The iterator returns strings of an arbitrary (short) length.
+    progress, if given, is called as progress(bytes_read, size) while
+    reading. Blocks are requested several at a time (see Brick.batch).
     """
 
-    def __init__(self, brick, fname):
+    def __init__(self, brick, fname, progress=None):
         self.brick = brick
+        self.progress = progress
         self.handle, self.size = brick.open_read(fname)
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def _read_blocks(self, remaining):
+        bsize = _bsize(self.brick)
+        with self.brick.batch() as batch:
+            for n in range(BLOCKS_PER_BATCH):
+                if remaining <= 0:
+                    break
+                batch.read(self.handle, min(bsize, remaining))
+                remaining -= bsize
+        data = ''.join(buffer_ for handle, n_bytes, buffer_ in batch.results)
+        self._position += len(data)
+        if self.progress is not None:
+            self.progress(self._position, self.size)
+        return data
 
     def read(self, bytes=None):
+        remaining = self.size - self._position
         if bytes is not None:
-            remaining = bytes
-        else:
-            remaining = self.size
-        bsize = self.brick.sock.bsize
+            remaining = min(bytes, remaining)
         data = []
         while remaining > 0:
-            handle, bsize, buffer_ = self.brick.read(self.handle,
-                min(bsize, remaining))
+            buffer_ = self._read_blocks(remaining)
+            if not buffer_:
+                break
             remaining -= len(buffer_)
             data.append(buffer_)
         return ''.join(data)
@@ -133,52 +396,84 @@ class FileReader(object):
         self.close()
 
     def __iter__(self):
-        rem = self.size
-        bsize = self.brick.sock.bsize
-        while rem > 0:
-            handle, bsize, data = self.brick.read(self.handle,
-                min(bsize, rem))
+        while self._position < self.size:
+            data = self._read_blocks(self.size - self._position)
+            if not data:
+                break
             yield data
-            rem -= len(data)
 
 
 class FileWriter(object):
-    "Object to write to a file on a NXT brick"
+    """Object to write to a file on a NXT brick. mode selects how the file is
+    opened: 'linear' (contiguous in flash, needed for programs, sounds and
+    icons), 'data' (may be appended to later) or 'normal'. If it is None, the
+    mode is picked from the file name extension (see LINEAR_EXTENSIONS).
+    progress, if given, is called as progress(bytes_written, size) while
+    writing. Blocks are sent several at a time (see Brick.batch), and close()
+    raises SysProtError if fewer than size bytes were written.
+    """
 
-    def __init__(self, brick, fname, size):
+    def __init__(self, brick, fname, size, mode=None, progress=None):
         self.brick = brick
-        self.handle = self.brick.open_write(fname, size)
+        if mode is None:
+            if fname.lower().endswith(LINEAR_EXTENSIONS):
+                mode = 'linear'
+            else:
+                mode = 'normal'
+        open_func = {
+            'normal': brick.open_write,
+            'linear': brick.open_write_linear,
+            'data': brick.open_write_data,
+        }[mode]
+        self.handle = open_func(fname, size)
+        self.progress = progress
         self._position = 0
         self.size = size
 
     def __del__(self):
-        self.close()
+        self._close()
 
-    def close(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etp, value, tb):
+        if etp is None:
+            self.close()
+        else:
+            self._close()
+
+    def _close(self):
         if self.handle is not None:
             self.brick.close(self.handle)
             self.handle = None
 
+    def close(self):
+        if self.handle is not None:
+            self._close()
+            if self._position != self.size:
+                raise SysProtError('File closed after writing %d of %d bytes'
+                    % (self._position, self.size))
+
     def tell(self):
         return self._position
 
     def write(self, data):
-        remaining = len(data)
-        if remaining > self.size - self._position:
+        if len(data) > self.size - self._position:
             raise ValueError('Data will not fit into remaining space')
-        bsize = self.brick.sock.bsize
-        data_position = 0
-
-        while remaining > 0:
-            batch_size = min(bsize, remaining)
-            next_data_position = data_position + batch_size
-            buffer_ = data[data_position:next_data_position]
-
-            handle, size = self.brick.write(self.handle, buffer_)
-
-            self._position += batch_size
-            data_position = next_data_position
-            remaining -= batch_size
+        bsize = _bsize(self.brick)
+        step = bsize * BLOCKS_PER_BATCH
+        for start in range(0, len(data), step):
+            end = min(start + step, len(data))
+            with self.brick.batch() as batch:
+                for pos in range(start, end, bsize):
+                    batch.write(self.handle, data[pos:min(pos + bsize, end)])
+            written = sum(n_bytes for handle, n_bytes in batch.results)
+            self._position += written
+            if self.progress is not None:
+                self.progress(self._position, self.size)
+            if written != end - start:
+                raise SysProtError('Brick accepted %d of %d bytes'
+                    % (written, end - start))
 
 
 class ModuleFinder(object):
@@ -219,8 +514,70 @@ class Brick(object): #TODO: this begs to have explicit methods
 
     def __init__(self, sock):
         self.sock = sock
-        self.lock = Lock()
+        self.lock = BrickLock()
         self.mc = MotCont(self)
+        self.latency = {}
+        self.ls_stats = {}
+        self.i2c_scheduler = I2CScheduler(self)
+        self.reply_policy = None
+        self.instrument = Instrument()
+        self.io = None
+
+    def stats(self):
+        """Returns a snapshot of the command counters, see
+        nxt.instrument.Instrument.snapshot (None if brick.instrument was set
+        to None), with the BrickLock.stats of brick.lock under 'lock' and
+        the IOThread.stats under 'io' while there is one.
+        """
+        if self.instrument is None:
+            return None
+        stats = self.instrument.snapshot()
+        stats['lock'] = self.lock.stats()
+        if self.io is not None:
+            stats['io'] = self.io.stats()
+        return stats
+
+    def start_io_thread(self, window=None):
+        """Makes a single thread send all commands of this brick from now
+        on, and returns that nxt.iothread.IOThread.
+        """
+        from nxt.iothread import IOThread
+        if self.io is None:
+            self.io = IOThread(self, window)
+        return self.io
+
+    def stop_io_thread(self):
+        'Sends the queued commands and goes back to sending them directly'
+        io, self.io = self.io, None
+        if io is not None:
+            io.stop()
+
+    def batch(self, window=None, priority=None):
+        'Returns a Batch to send several commands back-to-back'
+        return Batch(self, window, priority)
+
+    def upload(self, fname, data, mode=None, progress=None, verify=True):
+        """Writes the string data to the file fname on the brick. See
+        FileWriter for mode and progress. If verify is True, the size of the
+        file is checked on the brick afterwards.
+        """
+        with FileWriter(self, fname, len(data), mode, progress) as f:
+            f.write(data)
+        if verify:
+            for name, size in FileFinder(self, fname):
+                if size != len(data):
+                    raise SysProtError('%s has %d bytes on the brick, not %d'
+                        % (fname, size, len(data)))
+
+    def download(self, fname, progress=None):
+        'Returns the contents of the file fname on the brick'
+        with FileReader(self, fname, progress) as f:
+            return f.read()
+
+    def calibrate(self, samples=20, port=0):
+        'Measures link latency, see nxt.latency.calibrate'
+        from nxt.latency import calibrate
+        return calibrate(self, samples, port)
 
     def play_tone_and_wait(self, frequency, duration):
         self.play_tone(frequency, duration)
@@ -233,3 +590,29 @@ class Brick(object): #TODO: this begs to have explicit methods
     find_modules = ModuleFinder
     open_file = File
     get_sensor = get_sensor
+
+
+def broadcast(bricks, method, *args, **kwargs):
+    """Calls the Brick method (given by name) with the same arguments on all
+    bricks at once, each in its own thread, so that a command reaches many
+    bricks in about one round trip time. Returns a list with the result for
+    every brick (None where it failed) and a dictionary mapping the index of
+    every brick which failed to its exception.
+    """
+    results = [None] * len(bricks)
+    errors = {}
+    def call(i, brick):
+        try:
+            results[i] = getattr(brick, method)(*args, **kwargs)
+        except Exception, err:
+            errors[i] = err
+    threads = []
+    for i, brick in enumerate(bricks):
+        thread = Thread(target=call, args=(i, brick),
+                        name='nxt-broadcast-%s' % method)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results, errors
@@ -14,6 +14,21 @@
 
 'Use for direct communication with the NXT ***EXTREMELY ADVANCED USERS ONLY***'
 
+from nxt.utils import layout
+
+# Precompiled request and reply layouts, so that fixed-size telegrams are
+# packed and parsed with a single struct call.
+_PLAY_TONE = layout('HH')
+_OUTPUT_STATE = layout('BbBBbBI')
+_INPUT_MODE = layout('BBB')
+_OUTPUT_STATE_REPLY = layout('BbBBbBIiii')
+_INPUT_VALUES_REPLY = layout('BBBBBHHhh')
+_PORT_RELATIVE = layout('BB')
+_LS_WRITE = layout('BBB')
+_MESSAGE_WRITE = layout('BB')
+_MESSAGE_READ = layout('BBB')
+_MESSAGE_READ_REPLY = layout('BB')
+
 def _create(opcode, need_reply = True):
     'Create a simple direct telegram'
     from telegram import Telegram
@@ -39,27 +54,19 @@ def play_sound_file(opcode, loop, fname):
 def play_tone(opcode, frequency, duration):
     'Play a tone at frequency (Hz) for duration (ms)'
     tgram = _create(opcode, False)
-    tgram.add_u16(frequency)
-    tgram.add_u16(duration)
+    tgram.add_struct(_PLAY_TONE, frequency, duration)
     return tgram
 
 def set_output_state(opcode, port, power, mode, regulation, turn_ratio,
     run_state, tacho_limit):
     tgram = _create(opcode, False)
-    tgram.add_u8(port)
-    tgram.add_s8(power)
-    tgram.add_u8(mode)
-    tgram.add_u8(regulation)
-    tgram.add_s8(turn_ratio)
-    tgram.add_u8(run_state)
-    tgram.add_u32(tacho_limit)
+    tgram.add_struct(_OUTPUT_STATE, port, power, mode, regulation, turn_ratio,
+        run_state, tacho_limit)
     return tgram
 
 def set_input_mode(opcode, port, sensor_type, sensor_mode):
     tgram = _create(opcode, False)
-    tgram.add_u8(port)
-    tgram.add_u8(sensor_type)
-    tgram.add_u8(sensor_mode)
+    tgram.add_struct(_INPUT_MODE, port, sensor_type, sensor_mode)
     return tgram
 
 def get_output_state(opcode, port):
@@ -69,18 +76,9 @@ def get_output_state(opcode, port):
 
 def _parse_get_output_state(tgram):
     tgram.check_status()
-    port = tgram.parse_u8()
-    power = tgram.parse_s8()
-    mode = tgram.parse_u8()
-    regulation = tgram.parse_u8()
-    turn_ratio = tgram.parse_s8()
-    run_state = tgram.parse_u8()
-    tacho_limit = tgram.parse_u32()
-    tacho_count = tgram.parse_s32()
-    block_tacho_count = tgram.parse_s32()
-    rotation_count = tgram.parse_s32()
-    return (port, power, mode, regulation, turn_ratio, run_state,
-        tacho_limit, tacho_count, block_tacho_count, rotation_count)
+    # (port, power, mode, regulation, turn_ratio, run_state, tacho_limit,
+    #  tacho_count, block_tacho_count, rotation_count)
+    return tgram.parse_struct(_OUTPUT_STATE_REPLY)
 
 def get_input_values(opcode, port):
     tgram = _create(opcode)
@@ -89,17 +87,9 @@ def get_input_values(opcode, port):
 
 def _parse_get_input_values(tgram):
     tgram.check_status()
-    port = tgram.parse_u8()
-    valid = tgram.parse_u8()
-    calibrated = tgram.parse_u8()
-    sensor_type = tgram.parse_u8()
-    sensor_mode = tgram.parse_u8()
-    raw_ad_value = tgram.parse_u16()
-    normalized_ad_value = tgram.parse_u16()
-    scaled_value = tgram.parse_s16()
-    calibrated_value = tgram.parse_s16()
-    return (port, valid, calibrated, sensor_type, sensor_mode, raw_ad_value,
-        normalized_ad_value, scaled_value, calibrated_value)
+    # (port, valid, calibrated, sensor_type, sensor_mode, raw_ad_value,
+    #  normalized_ad_value, scaled_value, calibrated_value)
+    return tgram.parse_struct(_INPUT_VALUES_REPLY)
 
 def reset_input_scaled_value(opcode, port):
     tgram = _create(opcode)
@@ -108,16 +98,14 @@ def reset_input_scaled_value(opcode, port):
 
 def message_write(opcode, inbox, message):
     tgram = _create(opcode)
-    tgram.add_u8(inbox)
-    tgram.add_u8(len(message) + 1)
-    tgram.add_string(len(message), message)
-    tgram.add_u8(0)
+    tgram.add_struct(_MESSAGE_WRITE, inbox, len(message) + 1)
+    # the string is null padded to the given size, adding the terminator
+    tgram.add_string(len(message) + 1, message)
     return tgram
 
 def reset_motor_position(opcode, port, relative):
     tgram = _create(opcode)
-    tgram.add_u8(port)
-    tgram.add_u8(relative)
+    tgram.add_struct(_PORT_RELATIVE, port, relative)
     return tgram
 
 def get_battery_level(opcode):
@@ -153,9 +141,7 @@ def _parse_ls_get_status(tgram):
 def ls_write(opcode, port, tx_data, rx_bytes):
     'Write a low-speed command to a sensor (ultrasonic)'
     tgram = _create(opcode)
-    tgram.add_u8(port)
-    tgram.add_u8(len(tx_data))
-    tgram.add_u8(rx_bytes)
+    tgram.add_struct(_LS_WRITE, port, len(tx_data), rx_bytes)
     tgram.add_string(len(tx_data), tx_data)
     return tgram
 
@@ -181,15 +167,12 @@ def _parse_get_current_program_name(tgram):
 
 def message_read(opcode, remote_inbox, local_inbox, remove):
     tgram = _create(opcode)
-    tgram.add_u8(remote_inbox)
-    tgram.add_u8(local_inbox)
-    tgram.add_u8(remove)
+    tgram.add_struct(_MESSAGE_READ, remote_inbox, local_inbox, remove)
     return tgram
 
 def _parse_message_read(tgram):
     tgram.check_status()
-    local_inbox = tgram.parse_u8()
-    n_bytes = tgram.parse_u8()
+    local_inbox, n_bytes = tgram.parse_struct(_MESSAGE_READ_REPLY)
     message = tgram.parse_string()
     return (local_inbox, message[:n_bytes])
 
@@ -216,3 +199,8 @@ OPCODES = {
     0x11: (get_current_program_name, _parse_get_current_program_name, 'Gets the name of the currently running program'),
     0x13: (message_read, _parse_message_read, 'Reads the next message sent from the NXT brick'),
 }
+
+# Commands whose reply is nothing but a status byte. They may be sent with or
+# without asking for a reply (see Brick.reply_policy).
+NO_REPLY_OPCODES = frozenset(opcode for opcode in OPCODES
+                             if OPCODES[opcode][1] is _parse_simple)
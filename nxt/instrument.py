@@ -0,0 +1,291 @@
+# nxt.instrument module -- Counters for the traffic of a NXT brick
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to see what a Brick spends its link time on. Every Brick counts the
+commands it sends in brick.instrument; brick.stats() returns a snapshot:
+
+    stats = brick.stats()
+    for name, op in sorted(stats['opcodes'].items(),
+                           key=lambda item: -item[1]['time']):
+        print name, op['calls'], op['time'], op['lock_wait']
+
+Callbacks added with brick.instrument.add_callback(func) are called as
+func(sample) after every command, with a Sample. Set brick.instrument to
+None to turn the counting off.
+
+brick.lock is a BrickLock, which also records how long each opcode waited
+for the link and held it, and lets urgent commands go first (see
+nxt.brick.get_priority).
+"""
+
+import heapq
+from collections import namedtuple
+from itertools import count
+from threading import Condition, Lock, current_thread
+from time import time
+
+from nxt.telegram import OPCODES
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket
+# counts everything slower
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+# One command as seen by the Brick: the telegram sizes in bytes, the time
+# spent waiting for the brick lock and the time from sending the command to
+# parsing its reply (seconds), and the exception raised, if any
+Sample = namedtuple('Sample', 'opcode name bytes_sent bytes_received '
+                    'lock_wait elapsed error')
+
+
+def opcode_name(opcode):
+    'Returns the name of the Brick method sending opcode'
+    try:
+        return OPCODES[opcode][0].__name__
+    except KeyError:
+        return '0x%02X' % opcode
+
+
+class OpcodeStats(object):
+    'The counters of one opcode'
+    def __init__(self):
+        self.calls = 0
+        self.no_reply = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.time = 0.0
+        self.lock_wait = 0.0
+        self.max_lock_wait = 0.0
+        self.errors = {}
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, sample):
+        self.calls += 1
+        if not sample.bytes_received:
+            self.no_reply += 1
+        self.bytes_sent += sample.bytes_sent
+        self.bytes_received += sample.bytes_received
+        self.time += sample.elapsed
+        self.lock_wait += sample.lock_wait
+        self.max_lock_wait = max(self.max_lock_wait, sample.lock_wait)
+        if sample.error is not None:
+            name = type(sample.error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if sample.elapsed <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.histogram[i] += 1
+
+    def as_dict(self):
+        return {'calls': self.calls, 'no_reply': self.no_reply,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received, 'time': self.time,
+                'lock_wait': self.lock_wait,
+                'max_lock_wait': self.max_lock_wait,
+                'errors': dict(self.errors),
+                'histogram': list(self.histogram)}
+
+
+class Instrument(object):
+    """Counts the commands of one Brick per opcode: calls, bytes, time, lock
+    wait, errors by exception class and a latency histogram (see
+    LATENCY_BUCKETS). It is thread safe; callbacks run in the thread which
+    sent the command, so they should be quick.
+    """
+    def __init__(self):
+        self._opcodes = {}
+        self._callbacks = []
+        self._lock = Lock()
+
+    def add_callback(self, func):
+        self._callbacks.append(func)
+
+    def remove_callback(self, func):
+        self._callbacks.remove(func)
+
+    def record(self, opcode, bytes_sent, bytes_received, lock_wait, elapsed,
+               error=None):
+        sample = Sample(opcode, opcode_name(opcode), bytes_sent,
+                        bytes_received, lock_wait, elapsed, error)
+        with self._lock:
+            stats = self._opcodes.get(sample.name)
+            if stats is None:
+                stats = self._opcodes[sample.name] = OpcodeStats()
+            stats.add(sample)
+        for func in self._callbacks:
+            func(sample)
+
+    def snapshot(self):
+        """Returns the counters as a dictionary: 'opcodes' maps opcode names
+        to their counters, the other keys are totals over all opcodes.
+        """
+        with self._lock:
+            opcodes = dict((name, stats.as_dict())
+                           for name, stats in self._opcodes.items())
+        totals = {'opcodes': opcodes, 'latency_buckets': LATENCY_BUCKETS}
+        for key in ('calls', 'bytes_sent', 'bytes_received', 'time',
+                    'lock_wait'):
+            totals[key] = sum(op[key] for op in opcodes.values())
+        totals['errors'] = sum(sum(op['errors'].values())
+                               for op in opcodes.values())
+        return totals
+
+    def reset(self):
+        with self._lock:
+            self._opcodes = {}
+
+
+# BrickLock priorities; lower values are served first
+URGENT = 0
+NORMAL = 1
+BULK = 2
+
+
+class _Timing(object):
+    'How often something happened and how long it took, in seconds'
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.max = max(self.max, elapsed)
+
+    def as_dict(self):
+        return {'count': self.count, 'time': self.time, 'max': self.max}
+
+
+class BrickLock(object):
+    """A lock for the link to a brick which keeps contention statistics:
+    the time spent waiting for it and the time it was held, per holder name
+    (the opcode name for Brick commands). When it is
+    released, the waiting thread with the lowest priority value gets it
+    next, ahead of threads which have waited longer; equal priorities (and
+    all threads, if priority_aware is False) are served first come, first
+    served. It can't preempt its holder: an urgent command still waits for
+    the command or Batch being sent to finish.
+
+    Used as a plain lock (with brick.lock: ...) it holds with NORMAL
+    priority under the name 'other'; hold(name, priority) returns a
+    context manager for both. acquire(blocking) works as for a Lock, with
+    priority and name as keyword arguments.
+    """
+    def __init__(self, priority_aware=True):
+        self.priority_aware = priority_aware
+        self._cond = Condition(Lock())
+        self._waiters = []
+        self._seq = count()
+        self._owner = None
+        self._name = None
+        self._acquired = 0.0
+        self._waits = {}
+        self._holds = {}
+        self.contended = 0
+        self.jumps = 0
+
+    def acquire(self, blocking=True, priority=NORMAL, name='other'):
+        if not self.priority_aware:
+            priority = NORMAL
+        started = time()
+        with self._cond:
+            entry = (priority, next(self._seq))
+            if self._owner is None and not self._waiters:
+                waited = False
+            elif not blocking:
+                return False
+            else:
+                waited = True
+                self.contended += 1
+                heapq.heappush(self._waiters, entry)
+                while self._owner is not None or self._waiters[0] != entry:
+                    self._cond.wait()
+                heapq.heappop(self._waiters)
+                # served ahead of threads which came earlier?
+                if any(seq < entry[1] for prio, seq in self._waiters):
+                    self.jumps += 1
+            self._owner = current_thread()
+            self._name = name
+            self._acquired = time()
+            timing = self._waits.get(name)
+            if timing is None:
+                timing = self._waits[name] = _Timing()
+            timing.add(self._acquired - started if waited else 0.0)
+        return True
+
+    def release(self):
+        with self._cond:
+            if self._owner is None:
+                raise RuntimeError('Release of an unlocked BrickLock')
+            timing = self._holds.get(self._name)
+            if timing is None:
+                timing = self._holds[self._name] = _Timing()
+            timing.add(time() - self._acquired)
+            self._owner = None
+            if self._waiters:
+                self._cond.notify_all()
+
+    def locked(self):
+        return self._owner is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, etp, value, tb):
+        self.release()
+
+    def hold(self, name, priority=NORMAL):
+        'Returns a context manager holding the lock as name with priority'
+        return _Hold(self, name, priority)
+
+    def waiting(self):
+        'Returns the number of threads waiting for the lock'
+        return len(self._waiters)
+
+    def stats(self):
+        """Returns the contention statistics as a dictionary: 'waits' and
+        'holds' map holder names to the count, total and maximum time of
+        their waits for the lock and of their holds; 'contended' is how many
+        acquisitions had to wait and 'jumps' how many of those were served
+        before earlier waiters.
+        """
+        with self._cond:
+            return {'waits': dict((name, timing.as_dict())
+                                  for name, timing in self._waits.items()),
+                    'holds': dict((name, timing.as_dict())
+                                  for name, timing in self._holds.items()),
+                    'contended': self.contended, 'jumps': self.jumps,
+                    'waiting': len(self._waiters)}
+
+    def reset(self):
+        with self._cond:
+            self._waits = {}
+            self._holds = {}
+            self.contended = 0
+            self.jumps = 0
+
+
+class _Hold(object):
+    def __init__(self, lock, name, priority):
+        self.lock = lock
+        self.name = name
+        self.priority = priority
+
+    def __enter__(self):
+        self.lock.acquire(priority=self.priority, name=self.name)
+        return self.lock
+
+    def __exit__(self, etp, value, tb):
+        self.lock.release()
@@ -0,0 +1,291 @@
+# nxt.iothread module -- One thread talking to a LEGO Mindstorms NXT brick
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to let a single thread do all the talking to a brick:
+
+    io = brick.start_io_thread()
+    future = io.get_battery_level()     # returns at once
+    brick.get_input_values(PORT_1)      # queued too, waits for the reply
+    print future.result(timeout=1)
+    brick.stop_io_thread()
+
+While the thread runs, the Brick methods (and Batches) of all threads queue
+their commands instead of taking turns on brick.lock, and the IOThread has
+the same opcode methods, which return a nxt.utils.Future. Commands are sent
+in order of priority (see nxt.brick.get_priority), so motor stops go ahead
+of queued sensor reads and file transfers, and up to window replies are
+outstanding at a time. A queued set_output_state or set_input_mode is
+replaced by a later one for the same port; both callers get the result of
+the later command. The commands of a Batch are sent in the order they were
+queued; only more urgent commands of other threads are sent in between.
+"""
+
+import heapq
+from collections import deque
+from itertools import count
+from threading import Condition, Thread
+from time import time
+
+from nxt.brick import _Meta, _set_reply, get_priority
+from nxt.instrument import NORMAL
+from nxt.motor import PORT_ALL
+from nxt.telegram import Telegram
+from nxt.utils import Future
+
+# Opcodes of which only the last queued command for a port matters
+COALESCED_OPCODES = frozenset([
+    0x04, # set_output_state
+    0x05, # set_input_mode
+])
+
+# Numbers the IOThread threads
+_thread_ids = count(1)
+
+
+class _Command(object):
+    def __init__(self, opcode, ogram, parse_func, priority):
+        self.opcode = opcode
+        self.ogram = ogram
+        self.parse_func = parse_func
+        self.priority = priority
+        self.future = Future()
+        self.queued = time()
+        self.sent = None
+        self.pkt = None
+        self.replaced = []
+        self.done = False
+
+    def port(self):
+        return ord(str(self.ogram)[2])
+
+    def finish(self, result=None, error=None):
+        self.done = True
+        for command in [self] + self.replaced:
+            if error is not None:
+                command.future.set_exception(error)
+            else:
+                command.future.set_result(result)
+
+
+def _make_enqueuer(opcode, poll_func, parse_func):
+    def enqueue(self, *args, **kwargs):
+        reply = kwargs.pop('reply', None)
+        priority = kwargs.pop('priority', None)
+        ogram = poll_func(opcode, *args, **kwargs)
+        _set_reply(self.brick, opcode, ogram, reply)
+        return self.submit(opcode, ogram, parse_func, priority)
+    return enqueue
+
+class _IOMeta(_Meta):
+    'Metaclass which adds one future-returning method for each opcode'
+
+    make_method = staticmethod(_make_enqueuer)
+
+
+class IOThread(object):
+    """Sends the commands queued for brick from a single thread, most urgent
+    first. window is the maximum number of replies outstanding at a time,
+    the pipeline_depth of the brick's socket by default. The thread holds
+    brick.lock while it has commands in flight, so code which still takes
+    the lock itself keeps working.
+
+    Future callbacks run in the I/O thread; they must not wait for commands
+    of the same brick.
+    """
+
+    __metaclass__ = _IOMeta
+
+    def __init__(self, brick, window=None):
+        self.brick = brick
+        if window is None:
+            window = getattr(brick.sock, 'pipeline_depth', 1)
+        self.window = max(1, window)
+        # metrics
+        self.commands = 0
+        self.coalesced = 0
+        self.max_queued = 0
+        self._queue = [] # (priority, sequence number, list of commands)
+        # (priority, the rest of the list) of the commands being sent; a
+        # more urgent list interrupts a less urgent one
+        self._groups = []
+        self._seq = count()
+        self._cond = Condition()
+        self._running = True
+        self._thread = Thread(target=self._run,
+                              name='nxt-io-%d' % next(_thread_ids))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, opcode, ogram, parse_func, priority=None):
+        """Queues the telegram ogram and returns a Future for its parsed
+        reply (None if it doesn't ask for one).
+        """
+        if priority is None:
+            priority = get_priority(opcode, ogram)
+        command = _Command(opcode, ogram, parse_func, priority)
+        with self._cond:
+            if opcode in COALESCED_OPCODES:
+                self._coalesce(command)
+            self._put(command.priority, [command])
+        return command.future
+
+    def submit_batch(self, commands, priority=None):
+        """Queues the (opcode, ogram, parse_func) commands as one unit, which
+        is sent in the given order, without other commands in between and
+        without coalescing. priority defaults to the most urgent one of the
+        commands. Returns the list of their Futures.
+        """
+        if priority is None:
+            priority = min([get_priority(opcode, ogram)
+                            for opcode, ogram, parse_func in commands] or
+                           [NORMAL])
+        group = [_Command(opcode, ogram, parse_func, priority)
+                 for opcode, ogram, parse_func in commands]
+        if group:
+            with self._cond:
+                self._put(priority, group)
+        return [command.future for command in group]
+
+    def _put(self, priority, group):
+        if not self._running:
+            raise EOFError('IOThread stopped')
+        heapq.heappush(self._queue, (priority, next(self._seq), group))
+        self.commands += len(group)
+        self.max_queued = max(self.max_queued, self.pending())
+        self._cond.notify()
+
+    def _coalesce(self, command):
+        port = command.port()
+        kept = []
+        for entry in self._queue:
+            if len(entry[2]) != 1:
+                kept.append(entry) # a batch
+                continue
+            old = entry[2][0]
+            if old.opcode == command.opcode and (old.port() == port or
+                    command.opcode == 0x04 and port == PORT_ALL):
+                command.replaced.append(old)
+                command.replaced.extend(old.replaced)
+                command.priority = min(command.priority, old.priority)
+                if old.ogram.reply and not command.ogram.reply:
+                    command.ogram.set_reply(True)
+                self.coalesced += 1
+            else:
+                kept.append(entry)
+        if len(kept) != len(self._queue):
+            self._queue = kept
+            heapq.heapify(self._queue)
+
+    def pending(self):
+        'Returns the number of queued commands not sent yet'
+        return (sum(len(group) for priority, seq, group in self._queue) +
+                sum(len(group) for priority, group in self._groups))
+
+    def stop(self):
+        """Sends the commands already queued, then stops the thread. Commands
+        submitted afterwards raise EOFError.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self):
+        'Returns the queue metrics as a dictionary'
+        return {'commands': self.commands, 'coalesced': self.coalesced,
+                'queued': self.pending(), 'max_queued': self.max_queued}
+
+    def _next(self, in_flight):
+        with self._cond:
+            while (not self._queue and not self._groups and not in_flight
+                   and self._running):
+                self._cond.wait()
+            if len(in_flight) >= self.window:
+                return None
+            if self._queue and (not self._groups or
+                                self._queue[0][0] < self._groups[-1][0]):
+                priority, seq, group = heapq.heappop(self._queue)
+                self._groups.append((priority, deque(group)))
+            if not self._groups:
+                return None
+            priority, group = self._groups[-1]
+            command = group.popleft()
+            if not group:
+                self._groups.pop()
+            return command
+
+    def _run(self):
+        in_flight = deque()
+        lock = None
+        while True:
+            command = self._next(in_flight)
+            if command is None and not in_flight:
+                break # stopped, and nothing is left
+            if lock is None:
+                lock = self.brick.lock.hold('io', command.priority)
+                lock.__enter__()
+            if command is None:
+                command = in_flight.popleft()
+                step = self._receive
+            else:
+                step = self._send
+            try:
+                step(command, in_flight)
+            except Exception, err:
+                # the link is out of step; fail everything in flight, and
+                # the rest of the batches being sent
+                failed = list(in_flight)
+                in_flight.clear()
+                with self._cond:
+                    for priority, group in self._groups:
+                        failed.extend(group)
+                    self._groups = []
+                if not command.done and command not in failed:
+                    failed.insert(0, command)
+                for c in failed:
+                    self._record(c, err)
+                    c.finish(error=err)
+            if not in_flight:
+                lock.__exit__(None, None, None)
+                lock = None
+
+    def _send(self, command, in_flight):
+        pkt = str(command.ogram)
+        command.sent = time()
+        self.brick.sock.send(pkt)
+        if command.ogram.reply:
+            in_flight.append(command)
+        else:
+            self._record(command)
+            command.finish()
+
+    def _receive(self, command, in_flight):
+        command.pkt = self.brick.sock.recv()
+        try:
+            result = command.parse_func(Telegram(opcode=command.opcode,
+                                                 pkt=command.pkt))
+        except Exception, err:
+            self._record(command, err)
+            command.finish(error=err)
+        else:
+            self._record(command)
+            command.finish(result)
+
+    def _record(self, command, error=None):
+        instrument = self.brick.instrument
+        if instrument is None:
+            return
+        sent = command.sent or time()
+        # the queue is where commands wait instead of the brick lock
+        instrument.record(command.opcode, len(str(command.ogram)),
+                          len(command.pkt or ''), sent - command.queued,
+                          time() - sent, error)
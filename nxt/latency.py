@@ -0,0 +1,64 @@
+# nxt.latency module -- Round trip time measurement for NXT connections
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to measure how long commands take on a live link. Brick.calibrate()
+stores the results in brick.latency, where Motor.turn and other code polling
+the brick pick them up instead of relying on per-connection-type guesses."""
+
+from time import time
+
+
+class LatencyProfile(object):
+    """Round trip time statistics (in seconds) of one command, computed from a
+    list of measured samples.
+    """
+    def __init__(self, samples):
+        if not samples:
+            raise ValueError('No samples')
+        self.samples = sorted(samples)
+        self.min = self.samples[0]
+        self.max = self.samples[-1]
+        self.mean = sum(self.samples) / len(self.samples)
+        self.p50 = self.percentile(50)
+        self.p99 = self.percentile(99)
+
+    def percentile(self, p):
+        'Returns the p-th percentile (nearest rank) of the samples'
+        index = int(round(p / 100.0 * (len(self.samples) - 1)))
+        return self.samples[index]
+
+    def __str__(self):
+        return 'p50 %.1f ms, p99 %.1f ms (%d samples)' % (self.p50 * 1000,
+            self.p99 * 1000, len(self.samples))
+
+
+def measure(func, samples, *args):
+    'Calls func(*args) samples times and returns a LatencyProfile'
+    times = []
+    for n in range(samples):
+        sent = time()
+        func(*args)
+        times.append(time() - sent)
+    return LatencyProfile(times)
+
+
+def calibrate(brick, samples=20, port=0):
+    """Measures the round trip time of keep_alive and of get_output_state
+    (on the given motor port) and stores the LatencyProfiles in the
+    brick.latency dictionary under the command names. Run it while nothing
+    else is using the brick, or waiting for the brick lock will be counted
+    too. Returns brick.latency.
+    """
+    brick.latency['keep_alive'] = measure(brick.keep_alive, samples)
+    brick.latency['get_output_state'] = measure(brick.get_output_state,
+        samples, port)
+    return brick.latency
@@ -12,7 +12,10 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-import traceback, ConfigParser, os
+import traceback, ConfigParser, os, sys, tempfile
+from threading import Thread, Lock
+from Queue import Queue
+from time import time
 
 class BrickNotFoundError(Exception):
     pass
@@ -31,56 +34,63 @@ find_one_brick. Any or all can be selected."""
         self.fantomusb = fantomusb
         self.fantombt = fantombt
 
-def find_bricks(host=None, name=None, silent=False, method=Method()):
-    """Used by find_one_brick to look for bricks ***ADVANCED USERS ONLY***"""
-    methods_available = 0
+def _search_usb(host, name, method):
+    import usbsock
+    return usbsock.find_bricks(host, name)
 
-    if method.usb:
+def _search_bluetooth(host, name, method):
+    import bluesock
+    def search():
         try:
-            import usbsock
-            methods_available += 1
-            socks = usbsock.find_bricks(host, name)
-            for s in socks:
+            for s in bluesock.find_bricks(host, name):
                 yield s
-        except ImportError:
-            import sys
-            if not silent: print >>sys.stderr, "USB module unavailable, not searching there"
-    
+        except (bluesock.bluetooth.BluetoothError, IOError): #for cases such as no adapter, bluetooth throws IOError, not BluetoothError
+            pass
+    return search()
+
+def _search_fantom(host, name, method):
+    import fantomsock
+    def search():
+        if method.fantomusb:
+            for s in fantomsock.find_bricks(host, name, False):
+                yield s
+        if method.fantombt:
+            for s in fantomsock.find_bricks(host, name, True):
+                yield s
+    return search()
+
+def _backends(method):
+    """Returns (label, search function) pairs for the backends selected by
+method. A search function raises ImportError if its comm library is missing,
+and otherwise returns an iterable of sockets."""
+    backends = []
+    if method.usb:
+        backends.append(('USB', _search_usb))
     if method.bluetooth:
-        try:
-            import bluesock
-            methods_available += 1
-            try:
-                socks = bluesock.find_bricks(host, name)
-                for s in socks:
-                    yield s
-            except (bluesock.bluetooth.BluetoothError, IOError): #for cases such as no adapter, bluetooth throws IOError, not BluetoothError
-                pass
-        except ImportError:
-            import sys
-            if not silent: print >>sys.stderr, "Bluetooth module unavailable, not searching there"
-    
+        backends.append(('Bluetooth', _search_bluetooth))
     if method.fantom:
+        backends.append(('Fantom', _search_fantom))
+    return backends
+
+def find_bricks(host=None, name=None, silent=False, method=Method()):
+    """Used by find_one_brick to look for bricks ***ADVANCED USERS ONLY***"""
+    methods_available = 0
+
+    for label, search in _backends(method):
         try:
-            import fantomsock
-            methods_available += 1
-            if method.fantomusb:
-                usbsocks = fantomsock.find_bricks(host, name, False)
-                for s in usbsocks:
-                    yield s
-            if method.fantombt:
-                btsocks = fantomsock.find_bricks(host, name, True)
-                for s in btsocks:
-                    yield s
+            socks = search(host, name, method)
         except ImportError:
-            import sys
-            if not silent: print >>sys.stderr, "Fantom module unavailable, not searching there"
-    
+            if not silent: print >>sys.stderr, "%s module unavailable, not searching there" % label
+            continue
+        methods_available += 1
+        for s in socks:
+            yield s
+
     if methods_available == 0:
         raise NoBackendError("No selected backends are available! Did you install the comm modules?")
 
 
-def find_one_brick(host=None, name=None, silent=False, strict=None, debug=False, method=None, confpath=None):
+def find_one_brick(host=None, name=None, silent=False, strict=None, debug=False, method=None, confpath=None, cache=True, cachepath=None):
     """Use to find one brick. The host and name args limit the search to 
 a given MAC or brick name. Set silent to True to stop nxt-python from 
 printing anything during the search. This function by default 
@@ -92,7 +102,10 @@ passing strict=False. This will, however, still tell the comm backends
 to only look for devices which match the args provided. The confpath arg 
 specifies the location of the configuration file which brick location 
 information will be read from if no brick location directives (host, 
-name, strict, or method) are provided."""
+name, strict, or method) are provided. If cache is True, bricks found 
+before (see read_cache) are connected to directly first, and a brick 
+found by a full search is added to the cache file at cachepath (by 
+default ~/.nxt-python-cache; the config file is never written)."""
     if debug and silent:
         silent=False
         print "silent and debug can't both be set; giving debug priority"
@@ -108,7 +121,12 @@ name, strict, or method) are provided."""
     if debug:
         print "Host: %s Name: %s Strict: %s" % (host, name, str(strict))
         print "USB: %s BT: %s Fantom: %s FUSB: %s FBT: %s" % (method.usb, method.bluetooth, method.fantom, method.fantombt, method.fantomusb)
-    
+
+    if cache:
+        b = _find_cached_brick(host, name, method, cachepath, debug)
+        if b is not None:
+            return b
+
     for s in find_bricks(host, name, silent, method):
         try:
             if host and 'host' in dir(s) and s.host != host:
@@ -129,6 +147,8 @@ name, strict, or method) are provided."""
                 if strict:
                     s.close()
                     continue
+            if cache:
+                remember_brick(s, info, cachepath, debug)
             return b
         except:
             if debug:
@@ -137,6 +157,114 @@ name, strict, or method) are provided."""
     #raise BrickNotFoundError
 
 
+class _Connector(Thread):
+    """Connects to one candidate socket in the background and checks that it
+is a brick matching host and name (if given)."""
+    def __init__(self, sock, host, name, debug, label):
+        Thread.__init__(self, name='nxt-connect-%s' % label)
+        self.daemon = True
+        self.sock = sock
+        self.brick_host = host
+        self.brick_name = name
+        self.debug = debug
+        self.brick = None
+        self.info = None
+        self.started = time()
+        self._abandoned = False
+        self._lock = Lock()
+
+    def run(self):
+        try:
+            b = self.sock.connect()
+            info = b.get_device_info()
+        except:
+            if self.debug:
+                traceback.print_exc()
+                print "Failed to connect to possible brick"
+            return
+        if ((self.brick_host and info[1] != self.brick_host) or
+                (self.brick_name and info[0].strip('\0') != self.brick_name)):
+            if self.debug:
+                print "Warning: the brick found does not match the host/name provided."
+            self.sock.close()
+            return
+        with self._lock:
+            if self._abandoned:
+                self.sock.close()
+                return
+            self.brick = b
+            self.info = info
+
+    def result(self, timeout):
+        """Waits until timeout seconds after the connection attempt started
+and returns the Brick, or None. Bricks which connect too late are closed."""
+        self.join(max(0, self.started + timeout - time()))
+        with self._lock:
+            if self.brick is None:
+                self._abandoned = True
+            return self.brick
+
+
+def find_all_bricks_parallel(host=None, name=None, silent=False, debug=False, method=None, timeout=5):
+    """Use to find every reachable brick quickly. All backends selected by
+method (USB only by default) are searched at the same time, and each
+candidate is connected to in its own thread as soon as it is found, with at
+most timeout seconds allowed per candidate. The host and name args limit
+the search like in find_one_brick (always strictly). Returns a dict mapping
+both the name and the MAC address of every brick found to its Brick
+object."""
+    if method is None: method = Method()
+    candidates = Queue()
+
+    def search(label, search_func):
+        try:
+            try:
+                socks = search_func(host, name, method)
+            except ImportError:
+                if not silent: print >>sys.stderr, "%s module unavailable, not searching there" % label
+                candidates.put(ImportError)
+                return
+            for s in socks:
+                candidates.put((label, s))
+        except:
+            if debug:
+                traceback.print_exc()
+        finally:
+            candidates.put(None)
+
+    backends = _backends(method)
+    for label, search_func in backends:
+        t = Thread(target=search, args=(label, search_func), name='nxt-search-%s' % label)
+        t.daemon = True
+        t.start()
+
+    connectors = []
+    searching = len(backends)
+    unavailable = 0
+    while searching:
+        s = candidates.get()
+        if s is None:
+            searching -= 1
+        elif s is ImportError:
+            unavailable += 1
+        else:
+            label, s = s
+            c = _Connector(s, host, name, debug,
+                           '%s-%d' % (label, len(connectors) + 1))
+            c.start()
+            connectors.append(c)
+    if unavailable == len(backends):
+        raise NoBackendError("No selected backends are available! Did you install the comm modules?")
+
+    bricks = {}
+    for c in connectors:
+        b = c.result(timeout)
+        if b is not None:
+            bricks[c.info[0].strip('\0')] = b
+            bricks[c.info[1]] = b
+    return bricks
+
+
 def server_brick(host, port = 2727):
     import ipsock
     sock = ipsock.IpSock(host, port)
@@ -152,6 +280,116 @@ def read_config(confpath=None, debug=False):
         conf.add_section('Brick')
     return conf
 
+CACHE_SECTION = 'Cache '
+
+def _cache_path(cachepath):
+    if not cachepath: cachepath = os.path.expanduser('~/.nxt-python-cache')
+    return cachepath
+
+def read_cache(cachepath=None):
+    """Returns the bricks remembered in the cache file (~/.nxt-python-cache
+by default) as a list of dicts with the keys name, host (MAC address), type
+('usb' or 'bluetooth'), address (where to connect: MAC address or
+'bus:address' for USB) and time (when the entry last changed), most recent
+first."""
+    conf = ConfigParser.RawConfigParser()
+    conf.read([_cache_path(cachepath)])
+    entries = []
+    for section in conf.sections():
+        if not section.startswith(CACHE_SECTION):
+            continue
+        entry = dict(conf.items(section))
+        entry['name'] = section[len(CACHE_SECTION):]
+        entry['time'] = float(entry.get('time', 0))
+        entries.append(entry)
+    entries.sort(key=lambda entry: entry['time'], reverse=True)
+    return entries
+
+def remember_brick(sock, info, cachepath=None, debug=False):
+    """Adds the brick connected through sock, whose get_device_info() reply
+is info, to the cache file. Only USB and Bluetooth connections are
+remembered, and the file is only written if the entry changed; it is
+replaced in one step, so readers never see it half written."""
+    stype = getattr(sock, 'type', None)
+    if stype == 'usb':
+        address = '%s:%s' % (sock.device.bus, sock.device.address)
+    elif stype == 'bluetooth':
+        address = sock.host
+    else:
+        return
+    cachepath = _cache_path(cachepath)
+    conf = ConfigParser.RawConfigParser()
+    conf.read([cachepath])
+    section = CACHE_SECTION + info[0].strip('\0')
+    values = {'host': info[1], 'type': stype, 'address': address}
+    if conf.has_section(section):
+        old = dict(conf.items(section))
+        if all(old.get(key) == value for key, value in values.items()):
+            return
+    else:
+        conf.add_section(section)
+    for key, value in values.items():
+        conf.set(section, key, value)
+    conf.set(section, 'time', '%.0f' % time())
+    try:
+        _write_atomically(conf, cachepath)
+    except (IOError, OSError):
+        if debug:
+            traceback.print_exc()
+            print "Warning: could not write the brick cache to %s" % cachepath
+
+def _write_atomically(conf, path):
+    fd, tmppath = tempfile.mkstemp(prefix='.nxt-python-cache',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            conf.write(f)
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # Windows doesn't rename over an existing file
+            os.remove(path)
+            os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+def _connect_cached(entry):
+    if entry['type'] == 'usb':
+        import usbsock
+        bus, address = entry['address'].split(':')
+        s = usbsock.find_brick_at(int(bus), int(address))
+        if s is None:
+            return None, None
+    else:
+        import bluesock
+        s = bluesock.BlueSock(entry['address'])
+    return s, s.connect()
+
+def _find_cached_brick(host, name, method, cachepath, debug):
+    for entry in read_cache(cachepath):
+        if (host and entry['host'] != host) or (name and entry['name'] != name):
+            continue
+        if not {'usb': method.usb, 'bluetooth': method.bluetooth}.get(entry['type']):
+            continue
+        try:
+            s, b = _connect_cached(entry)
+            if b is None:
+                continue
+            info = b.get_device_info()
+            if info[0].strip('\0') != entry['name'] or info[1] != entry['host']:
+                if debug:
+                    print "Warning: a different brick answered at the cached address of %s." % entry['name']
+                s.close()
+                continue
+            remember_brick(s, info, cachepath, debug)
+            return b
+        except:
+            if debug:
+                traceback.print_exc()
+                print "Failed to connect to cached brick %s" % entry['name']
+
 def make_config(confpath=None):
     conf = ConfigParser.RawConfigParser()
     if not confpath: confpath = os.path.expanduser('~/.nxt-python')
@@ -0,0 +1,233 @@
+# nxt.mailbox module -- Streaming data through LEGO Mindstorms NXT mailboxes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to exchange payloads of any size with a program running on the brick,
+at the rate the link allows rather than one round trip per value.
+
+Payloads are sent as records inside mailbox messages. Every record starts
+with a header byte holding the record's data length plus one in its low 7
+bits, and MORE (0x80) if the payload continues in the next record; the data
+follows. Several small payloads share one message, and large ones are split
+across messages. The program on the brick reads and writes the same format
+(a header byte is never 0, so messages stay valid NXC strings).
+"""
+
+from threading import Lock, Thread, Event
+from Queue import Queue, Empty
+
+from nxt.error import CODES
+from nxt.utils import TimeoutError
+
+# Longest message the firmware accepts, not counting the terminating null
+MAX_MESSAGE = 58
+
+# Header flag of a record whose payload continues in the next record
+MORE = 0x80
+
+_MAILBOX_EMPTY = CODES[0x40]
+
+
+def pack(payloads):
+    'Returns the list of messages carrying the given payloads'
+    messages = []
+    current = ''
+    for payload in payloads:
+        pos = 0
+        while True:
+            room = MAX_MESSAGE - len(current) - 1
+            if room <= 0:
+                messages.append(current)
+                current = ''
+                continue
+            chunk = payload[pos:pos + room]
+            pos += len(chunk)
+            more = pos < len(payload)
+            current += chr((len(chunk) + 1) | (MORE if more else 0)) + chunk
+            if not more:
+                break
+    if current:
+        messages.append(current)
+    return messages
+
+
+class Unpacker(object):
+    """Collects the records of incoming messages and returns the payloads
+    they complete. A payload may span several messages.
+    """
+    def __init__(self):
+        self._partial = []
+
+    def feed(self, message):
+        'Returns the list of payloads completed by message'
+        payloads = []
+        pos = 0
+        while pos < len(message):
+            header = ord(message[pos])
+            if header == 0:
+                break # the terminator
+            length = (header & ~MORE) - 1
+            self._partial.append(message[pos + 1:pos + 1 + length])
+            pos += 1 + length
+            if not header & MORE:
+                payloads.append(''.join(self._partial))
+                self._partial = []
+        return payloads
+
+
+class MailboxChannel(object):
+    """A two-way stream of payloads between the computer and a program on
+    the brick. Payloads are written to the brick's mailbox inbox (0-9), and
+    read from reply_inbox (by default inbox + 10, where NXC programs send
+    to the computer). Only one MailboxChannel should read a mailbox.
+
+    Once start()ed, a reader thread drains reply_inbox, asking for up to
+    burst messages at once (the pipeline_depth of the socket by default), and
+    queues the payloads for recv(). When the mailbox is empty it waits
+    poll_interval seconds before asking again.
+    """
+    def __init__(self, brick, inbox=0, reply_inbox=None, burst=None,
+                 poll_interval=0.01):
+        self.brick = brick
+        self.inbox = inbox
+        if reply_inbox is None:
+            reply_inbox = inbox + 10
+        self.reply_inbox = reply_inbox
+        if burst is None:
+            burst = getattr(brick.sock, 'pipeline_depth', 1)
+        self.burst = max(1, burst)
+        self.poll_interval = poll_interval
+        self.last_error = None
+        # metrics
+        self.messages_sent = 0
+        self.payloads_sent = 0
+        self.messages_read = 0
+        self.payloads_read = 0
+        self.bytes_read = 0
+        self.empty_polls = 0
+        self.max_depth = 0
+        self._outgoing = []
+        self._outgoing_bytes = 0
+        self._send_lock = Lock()
+        self._unpacker = Unpacker()
+        self._received = Queue()
+        self._stop = Event()
+        self._thread = None
+
+    def send(self, payload, flush=True):
+        """Sends the string payload. With flush=False it is only queued, to
+        share messages with later payloads; it goes out once a message is
+        full or flush() is called.
+        """
+        with self._send_lock:
+            self._outgoing.append(payload)
+            self._outgoing_bytes += len(payload) + 1
+            if flush or self._outgoing_bytes >= MAX_MESSAGE:
+                self._flush()
+
+    def flush(self):
+        'Sends all queued payloads'
+        with self._send_lock:
+            self._flush()
+
+    def _flush(self):
+        payloads, self._outgoing = self._outgoing, []
+        self._outgoing_bytes = 0
+        if not payloads:
+            return
+        messages = pack(payloads)
+        with self.brick.batch() as batch:
+            for message in messages:
+                batch.message_write(self.inbox, message)
+        self.messages_sent += len(messages)
+        self.payloads_sent += len(payloads)
+
+    def recv(self, timeout=None):
+        """Returns the next payload from the brick, waiting up to timeout
+        seconds (forever if None) for one to arrive.
+        """
+        try:
+            return self._received.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError('No payload within %s seconds' % timeout)
+
+    def depth(self):
+        'Returns the number of received payloads waiting for recv()'
+        return self._received.qsize()
+
+    def poll(self):
+        """Reads the messages waiting in reply_inbox now, queues their
+        payloads and returns how many messages there were.
+        """
+        batch = self.brick.batch(self.burst)
+        for i in range(self.burst):
+            batch.message_read(self.reply_inbox, self.inbox, True)
+        try:
+            results = batch.execute()
+        except Exception, err:
+            if err is not _MAILBOX_EMPTY:
+                raise
+            results = batch.results
+        n_messages = 0
+        for result in results:
+            if isinstance(result, Exception):
+                if result is not _MAILBOX_EMPTY:
+                    raise result
+                continue
+            message = result[1]
+            n_messages += 1
+            self.bytes_read += len(message)
+            for payload in self._unpacker.feed(message):
+                self._received.put(payload)
+                self.payloads_read += 1
+        self.messages_read += n_messages
+        if n_messages < self.burst:
+            self.empty_polls += 1
+        self.max_depth = max(self.max_depth, self.depth())
+        return n_messages
+
+    def start(self):
+        'Starts draining reply_inbox in a background thread'
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='nxt-mailbox-%d' %
+                              self.reply_inbox)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                full = self.poll() == self.burst
+                self.last_error = None
+            except Exception, err:
+                self.last_error = err
+                full = False
+            if not full:
+                self._stop.wait(self.poll_interval)
+
+    def stats(self):
+        'Returns the channel metrics as a dictionary'
+        return {'messages_sent': self.messages_sent,
+                'payloads_sent': self.payloads_sent,
+                'messages_read': self.messages_read,
+                'payloads_read': self.payloads_read,
+                'bytes_read': self.bytes_read,
+                'empty_polls': self.empty_polls,
+                'depth': self.depth(),
+                'max_depth': self.max_depth}
@@ -38,6 +38,13 @@ RUN_STATE_RAMP_DOWN = 0x40
 
 LIMIT_RUN_FOREVER = 0
 
+# Rough unloaded speed of a NXT motor, in degrees per second per unit of power
+DEGREES_PER_POWER_SECOND = 9
+
+# Motor.limited_turn waits for the rest of a turn in one go once it should
+# take less than this many seconds, as the firmware stops the motor anyway
+SHORT_TURN_TIME = 0.1
+
 class BlockedException(Exception):
     pass
 
@@ -139,7 +146,33 @@ class BaseMotor(object):
         if self.debug:
             print message
 
-    def turn(self, power, tacho_units, brake=True, timeout=1, emulate=True):
+    def _get_threshold(self, power):
+        """Returns how many degrees before the target turn() stops the motor.
+        If the link latency was measured (see Brick.calibrate), it is roughly
+        how far the motor gets during a slow (p99) round trip; otherwise it
+        is guessed from the connection type.
+        """
+        profile = self._get_latency('get_output_state')
+        if profile is not None:
+            return max(5, abs(power) * DEGREES_PER_POWER_SECOND * profile.p99)
+        if self.method == 'bluetooth':
+            threshold = 70
+        elif self.method == 'usb':
+            threshold = 5
+        elif self.method == 'ipbluetooth':
+            threshold = 80
+        elif self.method == 'ipusb':
+            threshold = 15
+        else:
+            threshold = 30 #compromise
+        return threshold
+
+    def _get_latency(self, command):
+        'Returns the LatencyProfile measured for command, or None'
+        return self.brick.latency.get(command)
+
+    def turn(self, power, tacho_units, brake=True, timeout=1, emulate=True,
+             cancel=None):
         """Use this to turn a motor. The motor will not stop until it turns the
         desired distance. Accuracy is much better over a USB connection than
         with bluetooth...
@@ -155,23 +188,16 @@ class BaseMotor(object):
                  tacho limit. If True, a run() function equivalent is used.
                  Warning: motors remember their positions and not using emulate
                  may lead to strange behavior, especially with synced motors
+        cancel is an optional threading.Event. Once it is set, the turn
+                 returns without braking or idling the motor: whoever set it
+                 is taking care of stopping the motor.
         """
   
         tacho_limit = tacho_units
  
         if tacho_limit < 0:
             raise ValueError, "tacho_units must be greater than 0!"
-        #TODO Calibrate the new values for ip socket latency.
-        if self.method == 'bluetooth':
-            threshold = 70
-        elif self.method == 'usb':
-            threshold = 5
-        elif self.method == 'ipbluetooth':
-            threshold = 80
-        elif self.method == 'ipusb':
-            threshold = 15
-        else:
-            threshold = 30 #compromise
+        threshold = self._get_threshold(power)
 
         tacho = self.get_tacho()
         state = self._get_new_state()
@@ -192,7 +218,10 @@ class BaseMotor(object):
         blocked = False
         try:
             while True:
-                time.sleep(self._eta(tacho, tacho_target, power) / 2)
+                if cancel is None:
+                    time.sleep(self._eta(tacho, tacho_target, power) / 2)
+                elif cancel.wait(self._eta(tacho, tacho_target, power) / 2):
+                    break
                 
                 if not blocked: # if still blocked, don't reset the counter
                     last_tacho = tacho
@@ -214,7 +243,9 @@ class BaseMotor(object):
                 if tacho.is_near(tacho_target, threshold) or tacho.is_greater(tacho_target, direction):
                     break
         finally:
-            if brake:
+            if cancel is not None and cancel.is_set():
+                pass
+            elif brake:
                 self.brake()
             else:
                 self.idle()
@@ -310,7 +341,6 @@ class Motor(BaseMotor):
         REGULATION_MODE_SPEED
         """
         tacho_limit = tacho_units
-        tacho = self.get_tacho()
         state = self._get_new_state()
 
         # Update modifiers even if they aren't used, might have been changed
@@ -322,10 +352,100 @@ class Motor(BaseMotor):
         self._debug_out('Updating motor information...')
         self._set_state(state)
     
+    def limited_turn(self, power, tacho_units, brake=True, timeout=1,
+                     ramp_down=0):
+        """Turns the motor by tacho_units degrees, leaving it to the firmware
+        to stop the motor at the tacho limit instead of stopping it from
+        here, so the result doesn't depend on the latency of the connection.
+        Meanwhile the output state is polled on a schedule derived from the
+        measured speed of the motor and the measured round trip time of the
+        link, which takes only a handful of polls per turn.
+        If ramp_down is given, the firmware slows the motor down to a stop
+        (RUN_STATE_RAMP_DOWN) over about the last ramp_down degrees, which
+        overshoots less at high power.
+        brake and timeout are as in turn(): a BlockedException is raised if
+        the motor doesn't advance for timeout seconds.
+        """
+        if power == 0:
+            raise ValueError, "power must not be 0!"
+        if tacho_units <= 0:
+            raise ValueError, "tacho_units must be greater than 0!"
+        ramp_from = tacho_units - max(0, min(ramp_down, tacho_units))
+        sent = time.time()
+        origin = self._read_state()[1].tacho_count
+        latency = time.time() - sent
+        profile = self._get_latency('get_output_state')
+        if profile is not None:
+            latency = profile.p50
+
+        state = self._get_new_state()
+        state.power = power
+        state.tacho_limit = tacho_units
+        if brake:
+            state.mode |= MODE_BRAKE
+        self._debug_out('Updating motor information...')
+        self._set_state(state)
+
+        direction = 1 if power > 0 else -1
+        speed = None # degrees per second, once measured
+        progress = 0
+        ramping = ramp_from == tacho_units
+        last_advance = time.time()
+        try:
+            while True:
+                if ramping:
+                    remaining = tacho_units - progress
+                else:
+                    # wake up in time to start the ramp
+                    remaining = ramp_from - progress
+                if speed:
+                    eta = remaining / speed
+                else:
+                    eta = (float(remaining) / abs(power) /
+                           DEGREES_PER_POWER_SECOND)
+                if ramping and eta <= SHORT_TURN_TIME:
+                    delay = eta + latency
+                else:
+                    # poll when about half of the rest should be done, so
+                    # that the number of polls grows only logarithmically,
+                    # but at most once per round trip
+                    delay = max(eta / 2 - latency, latency)
+                time.sleep(min(delay, timeout / 2.0))
+
+                sent = time.time()
+                values = self.brick.get_output_state(self.port)
+                now = time.time()
+                latency = (latency + now - sent) / 2
+                self._state, tacho = get_tacho_and_state(values)
+                advance = direction * (tacho.tacho_count - origin) - progress
+                if advance > 0:
+                    speed = advance / (now - last_advance)
+                    progress += advance
+                    last_advance = now
+                self._debug_out(('progress', progress, 'speed', speed,
+                                 'latency', latency))
+
+                if (self._state.run_state == RUN_STATE_IDLE or
+                        progress >= tacho_units):
+                    break
+                if not ramping and progress >= ramp_from:
+                    # the new limit counts from now on
+                    state.run_state = RUN_STATE_RAMP_DOWN
+                    state.tacho_limit = tacho_units - progress
+                    self._set_state(state)
+                    ramping = True
+                if now - last_advance > timeout:
+                    raise BlockedException("Blocked!")
+        finally:
+            if brake:
+                self.brake()
+            else:
+                self.idle()
+
     def _eta(self, current, target, power):
         """Returns time in seconds. Do not trust it too much"""
         tacho = abs(current.tacho_count - target.tacho_count)
-        return (float(tacho) / abs(power)) / 5
+        return (float(tacho) / abs(power)) / DEGREES_PER_POWER_SECOND
     
     def _is_blocked(self, tacho, last_tacho, direction):
         """Returns if any of the engines is blocked"""
@@ -347,6 +467,7 @@ class SynchronizedMotors(BaseMotor):
         self.leader = leader
         self.follower = follower
         self.method = self.leader.method #being from the same brick, they both have the same com method.
+        self.brick = self.leader.brick
         
         if turn_ratio < 0:
             raise ValueError('Turn ratio <0. Change motor order instead!')
@@ -412,16 +533,21 @@ class SynchronizedMotors(BaseMotor):
     def idle(self):
         self._disable()
 
-    def turn(self, power, tacho_units, brake=True, timeout=1):
+    def turn(self, power, tacho_units, brake=True, timeout=1, cancel=None):
         self._enable()
         # non-emulation is a nightmare, tacho is being counted differently
         try:
             if power < 0:
                 self.leader, self.follower = self.follower, self.leader
-            BaseMotor.turn(self, power, tacho_units, brake, timeout, emulate=True)
+            BaseMotor.turn(self, power, tacho_units, brake, timeout,
+                           emulate=True, cancel=cancel)
         finally:
             if power < 0:
                 self.leader, self.follower = self.follower, self.leader
+            # a cancelled turn returns without _disable(); the motors must
+            # not stay synced for later single motor commands
+            self.leader.sync = False
+            self.follower.sync = False
     
     def _eta(self, tacho, target, power):
         return self.leader._eta(tacho.leader_tacho, target.leader_tacho, power)
@@ -0,0 +1,150 @@
+# nxt.poller module -- Shared snapshots of LEGO Mindstorms NXT port state
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to read the sensor and motor ports of a brick once per tick and share
+the values between any number of readers."""
+
+from threading import Lock, Thread, Event
+from time import time
+
+from nxt.motor import get_tacho_and_state
+from nxt.sensor.analog import RawReading
+
+
+class _ReadOnlyDict(dict):
+    'A dictionary which can not be changed after it was created'
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('BrickState ports are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+
+class BrickState(object):
+    """An immutable snapshot of the input and output ports of a brick, taken
+    at self.time. inputs and outputs map a port to the tuple returned by
+    Brick.get_input_values and Brick.get_output_state respectively; they are
+    read-only, since all readers share them.
+    """
+    __slots__ = ('time', 'inputs', 'outputs')
+
+    def __init__(self, timestamp, inputs, outputs):
+        object.__setattr__(self, 'time', timestamp)
+        object.__setattr__(self, 'inputs', _ReadOnlyDict(inputs))
+        object.__setattr__(self, 'outputs', _ReadOnlyDict(outputs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('BrickState is read-only')
+
+    def age(self):
+        'Returns how old the snapshot is, in seconds'
+        return time() - self.time
+
+    def get_input_values(self, port):
+        return RawReading(self.inputs[port])
+
+    def get_output_state(self, port):
+        return self.outputs[port]
+
+    def get_tacho(self, port):
+        return get_tacho_and_state(self.outputs[port])[1]
+
+
+class BrickStatePoller(object):
+    """Fetches the given input and output ports of a brick in one pipelined
+    burst (see Brick.batch) and publishes the result as a BrickState. Once
+    start()ed, it does so rate times per second in a background thread
+    (rate may be changed while it runs);
+    readers call get_state() and never touch the link themselves unless the
+    snapshot is older than the max_age they ask for. If rate is None, it is
+    derived from the link latency measured by Brick.calibrate (20 if the
+    link wasn't calibrated).
+    """
+    def __init__(self, brick, input_ports=(), output_ports=(), rate=20):
+        self.brick = brick
+        self.input_ports = tuple(input_ports)
+        self.output_ports = tuple(output_ports)
+        self.rate = rate
+        self.last_error = None
+        self._state = None
+        self._refresh_lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def refresh(self):
+        'Reads all configured ports now and returns the new BrickState'
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        timestamp = time()
+        with self.brick.batch() as batch:
+            for port in self.input_ports:
+                batch.get_input_values(port)
+            for port in self.output_ports:
+                batch.get_output_state(port)
+        n_inputs = len(self.input_ports)
+        inputs = dict(zip(self.input_ports, batch.results[:n_inputs]))
+        outputs = dict(zip(self.output_ports, batch.results[n_inputs:]))
+        self._state = BrickState(timestamp, inputs, outputs)
+        return self._state
+
+    def get_state(self, max_age=None):
+        """Returns the latest BrickState. If there is none yet, or it is older
+        than max_age seconds, the ports are read first; readers which ask at
+        the same time share that one read.
+        """
+        state = self._state
+        if state is not None and (max_age is None or state.age() <= max_age):
+            return state
+        with self._refresh_lock:
+            state = self._state
+            if state is None or (max_age is not None and
+                                 state.age() > max_age):
+                state = self._refresh()
+            return state
+
+    def start(self):
+        'Starts polling in a background thread'
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='nxt-state-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _get_period(self):
+        if self.rate is not None:
+            return 1.0 / self.rate
+        profile = self.brick.latency.get('get_output_state')
+        if profile is None:
+            return 1.0 / 20
+        # leave the link idle for about as long as a slow burst takes
+        n_commands = len(self.input_ports) + len(self.output_ports)
+        return 2 * profile.p99 * max(1, n_commands / 2.0)
+
+    def _run(self):
+        while not self._stop.is_set():
+            period = self._get_period()
+            started = time()
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception, err:
+                self.last_error = err
+            self._stop.wait(max(0, period - (time() - started)))
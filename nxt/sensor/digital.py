@@ -14,9 +14,12 @@
 # GNU General Public License for more details.
 
 from nxt.error import I2CError, I2CPendingError, DirProtError
+from nxt.utils import Future
 
 from common import *
 from time import sleep, time
+from threading import Lock, RLock, Thread
+from Queue import Queue
 import struct
 
 
@@ -41,6 +44,138 @@ class SensorInfo:
         outstr += (self.clarifybinary(str(self.sensor_type), 'Type'))
         return outstr
 
+class LSStats(object):
+    """Timing statistics of the low speed (i2c) transactions on one port.
+    byte_time is the learnt time a transaction takes per byte read, used to
+    decide how long to wait before the first ls_get_status.
+    """
+    BYTE_TIME = 0.001 # about one byte per ms at the NXT's i2c clock
+    OVERHEAD = 3 # address bytes sent with each read
+    MIN_BACKOFF = 0.001
+    MAX_BACKOFF = 0.02
+
+    def __init__(self):
+        self.transactions = 0
+        self.status_polls = 0
+        self.timeouts = 0
+        self.byte_time = self.BYTE_TIME
+
+    def estimate(self, n_bytes):
+        'Returns how long a read of n_bytes is expected to take, in seconds'
+        return self.byte_time * (n_bytes + self.OVERHEAD)
+
+    def record(self, n_bytes, elapsed, polls):
+        """Adds a finished transaction which took elapsed seconds and polls
+        ls_get_status calls. If the first check already found the data,
+        waiting a little less next time may be possible; otherwise move
+        towards the time it really took.
+        """
+        self.transactions += 1
+        self.status_polls += polls
+        if polls == 1:
+            self.byte_time *= 0.9
+        else:
+            measured = elapsed / (n_bytes + self.OVERHEAD)
+            self.byte_time = (self.byte_time + measured) / 2
+
+    def __str__(self):
+        if not self.transactions:
+            return 'no transactions'
+        return '%d transactions, %.1f polls each, %.2f ms/byte, %d timeouts' % (
+            self.transactions, float(self.status_polls) / self.transactions,
+            self.byte_time * 1000, self.timeouts)
+
+
+class _PortState(object):
+    def __init__(self):
+        self.lock = RLock()
+        self.ready = 0
+        self.queue = None
+
+
+class I2CScheduler(object):
+    """Spaces out the i2c transactions on the ports of one brick. Every port
+    has its own quiet period after a transaction, which only holds up the
+    sensors on that port: transactions on other ports go ahead meanwhile.
+    Sensors sharing a port take turns. Every Brick has one as
+    brick.i2c_scheduler.
+    submit() runs a call in a thread of the port, so that one thread can
+    keep several ports busy at once:
+
+        futures = [sched.submit(s.port, s.get_sample) for s in sensors]
+        samples = [f.result() for f in futures]
+    """
+    def __init__(self, brick):
+        self.brick = brick
+        self._ports = {}
+        self._lock = Lock()
+
+    def _get_port(self, port):
+        with self._lock:
+            try:
+                return self._ports[port]
+            except KeyError:
+                return self._ports.setdefault(port, _PortState())
+
+    def acquire(self, port):
+        """Waits until the port is free and its quiet period is over. Every
+        acquire() must be followed by a release().
+        """
+        state = self._get_port(port)
+        state.lock.acquire()
+        wait = state.ready - time()
+        if wait > 0:
+            sleep(wait)
+
+    def release(self, port, quiet=0):
+        'Frees the port, keeping it quiet for the next quiet seconds'
+        state = self._get_port(port)
+        state.ready = time() + quiet
+        state.lock.release()
+
+    def submit(self, port, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) to run in the thread of the port and
+        returns a nxt.utils.Future of its result.
+        """
+        state = self._get_port(port)
+        future = Future()
+        with self._lock:
+            if state.queue is None:
+                state.queue = Queue()
+                thread = Thread(target=self._run, args=(state.queue, ),
+                                name='nxt-i2c-port%d' % (port + 1))
+                thread.daemon = True
+                thread.start()
+        state.queue.put((future, func, args, kwargs))
+        return future
+
+    def _run(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            try:
+                result = func(*args, **kwargs)
+            except Exception, err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        'Stops the port threads once they have run what was submitted'
+        with self._lock:
+            for state in self._ports.values():
+                if state.queue is not None:
+                    state.queue.put(None)
+                    state.queue = None
+
+
+def get_i2c_scheduler(brick):
+    'Returns the I2CScheduler of brick'
+    return brick.i2c_scheduler
+
+
 class BaseDigitalSensor(Sensor):
     """Object for digital sensors. I2C_ADDRESS is the dictionary storing name
     to i2c address mappings. It should be updated in every subclass. When
@@ -55,6 +190,7 @@ class BaseDigitalSensor(Sensor):
         'factory_scale_factor': (0x12, 'B'),
         'factory_scale_divisor': (0x13, 'B'),
     }
+    I2C_BURST_SIZE = 16 # the most bytes the NXT reads in one transaction
     
     def __init__(self, brick, port, check_compatible=True):
         """Creates a BaseDigitalSensor. If check_compatible is True, queries
@@ -63,8 +199,9 @@ class BaseDigitalSensor(Sensor):
         """
         super(BaseDigitalSensor, self).__init__(brick, port)
         self.set_input_mode(Type.LOW_SPEED_9V, Mode.RAW)
-        self.last_poll = time()
+        self.scheduler = get_i2c_scheduler(brick)
         self.poll_delay = 0.01
+        self._burst_plans = {}
         sleep(0.1)  # Give I2C time to initialize
         #Don't do type checking if this class has no compatible sensors listed.
         try: self.compatible_sensors
@@ -81,27 +218,45 @@ bug report, including the output of get_sensor_info(). This message can be
 suppressed by passing "check_compatible=False" when creating the sensor object.""")
 
     def _ls_get_status(self, n_bytes):
+        """Waits until n_bytes have been read from the sensor. Rather than
+        asking the brick over and over, sleeps for about as long as the
+        transaction took on this port before and backs off between checks.
+        """
+        stats = self.get_ls_stats()
+        started = time()
+        delay = stats.estimate(n_bytes)
         for n in range(30): #https://code.google.com/p/nxt-python/issues/detail?id=35
+            sleep(delay)
             try:
                 b = self.brick.ls_get_status(self.port)
                 if b >= n_bytes:
+                    stats.record(n_bytes, time() - started, n + 1)
                     return b
             except I2CPendingError:
                 pass
+            delay = min(max(delay, LSStats.MIN_BACKOFF) * 2,
+                        LSStats.MAX_BACKOFF)
+        stats.timeouts += 1
         raise I2CError, 'ls_get_status timeout'
 
+    def get_ls_stats(self):
+        'Returns the LSStats of the port, shared by all sensors on it'
+        try:
+            return self.brick.ls_stats[self.port]
+        except KeyError:
+            return self.brick.ls_stats.setdefault(self.port, LSStats())
+
     def _i2c_command(self, address, value, format):
         """Writes an i2c value to the given address. value must be a string. value is
         a tuple of values corresponding to the given format.
         """
         value = struct.pack(format, *value)
         msg = chr(self.I2C_DEV) + chr(address) + value
-        now = time()
-        if self.last_poll+self.poll_delay > now:
-            diff = now - self.last_poll
-            sleep(self.poll_delay - diff)
-        self.last_poll = time()
-        self.brick.ls_write(self.port, msg, 0)
+        self.scheduler.acquire(self.port)
+        try:
+            self.brick.ls_write(self.port, msg, 0)
+        finally:
+            self.scheduler.release(self.port, self.poll_delay)
 
     def _i2c_query(self, address, format):
         """Reads an i2c value from given address, and returns a value unpacked
@@ -110,17 +265,16 @@ suppressed by passing "check_compatible=False" when creating the sensor object."
         """
         n_bytes = struct.calcsize(format)
         msg = chr(self.I2C_DEV) + chr(address)
-        now = time()
-        if self.last_poll+self.poll_delay > now:
-            diff = now - self.last_poll
-            sleep(self.poll_delay - diff)
-        self.last_poll = time()
-        self.brick.ls_write(self.port, msg, n_bytes)
+        self.scheduler.acquire(self.port)
         try:
-            self._ls_get_status(n_bytes)
+            self.brick.ls_write(self.port, msg, n_bytes)
+            try:
+                self._ls_get_status(n_bytes)
+            finally:
+                #we should clear the buffer no matter what happens
+                data = self.brick.ls_read(self.port)
         finally:
-            #we should clear the buffer no matter what happens
-            data = self.brick.ls_read(self.port)
+            self.scheduler.release(self.port, self.poll_delay)
         if len(data) < n_bytes:
             raise I2CError, 'Read failure: Not enough bytes'
         data = struct.unpack(format, data[-n_bytes:])
@@ -141,6 +295,54 @@ suppressed by passing "check_compatible=False" when creating the sensor object."
                 pass
         raise I2CError, "read_value timeout"
 
+    def read_values(self, *names):
+        """Reads several values from the sensor in as few i2c transactions as
+        possible: registers close enough together to fit in one
+        I2C_BURST_SIZE byte read are fetched at once. Returns a list with one
+        tuple per name, each like read_value would return it.
+        """
+        try:
+            plan = self._burst_plans[names]
+        except KeyError:
+            plan = self._plan_burst(names)
+            self._burst_plans[names] = plan
+        values = {}
+        for address, n_bytes, fields in plan:
+            data = self._read_burst(address, n_bytes)
+            for name, offset, fmt in fields:
+                values[name] = struct.unpack_from(fmt, data, offset)
+        return [values[name] for name in names]
+
+    def _plan_burst(self, names):
+        """Groups the registers of the given names into (address, n_bytes,
+        fields) ranges no longer than I2C_BURST_SIZE, where fields lists the
+        (name, offset, format) of the values in each range.
+        """
+        registers = []
+        for name in set(names):
+            address, fmt = self.I2C_ADDRESS[name]
+            registers.append((address, address + struct.calcsize(fmt), name,
+                              fmt))
+        registers.sort()
+        plan = []
+        for address, end, name, fmt in registers:
+            if plan and end - plan[-1][0] <= self.I2C_BURST_SIZE:
+                start, n_bytes, fields = plan[-1]
+                plan[-1] = (start, max(n_bytes, end - start), fields)
+            else:
+                fields = []
+                plan.append((address, end - address, fields))
+            fields.append((name, address - plan[-1][0], fmt))
+        return plan
+
+    def _read_burst(self, address, n_bytes):
+        for n in range(3):
+            try:
+                return self._i2c_query(address, '%ds' % n_bytes)[0]
+            except DirProtError:
+                pass
+        raise I2CError, "read_values timeout"
+
     def write_value(self, name, value):
         """Writes value to the sensor. Name must be a string found in
         self.I2C_ADDRESS dictionary. Entries in self.I2C_ADDRESS are in the
@@ -152,9 +354,9 @@ suppressed by passing "check_compatible=False" when creating the sensor object."
         self._i2c_command(address, value, fmt)
     
     def get_sensor_info(self):
-        version = self.read_value('version')[0].split('\0')[0]
-        product_id = self.read_value('product_id')[0].split('\0')[0]
-        sensor_type = self.read_value('sensor_type')[0].split('\0')[0]
+        values = self.read_values('version', 'product_id', 'sensor_type')
+        version, product_id, sensor_type = [value[0].split('\0')[0]
+                                            for value in values]
         return SensorInfo(version, product_id, sensor_type)
         
     @classmethod
@@ -35,8 +35,8 @@ class Compass(BaseDigitalSensor):
     def get_heading(self):
         """Returns heading from North in degrees."""
 
-        two_degree_heading = self.read_value('heading')[0]
-        adder = self.read_value('adder')[0]
+        heading, adder = self.read_values('heading', 'adder')
+        two_degree_heading, adder = heading[0], adder[0]
         heading = two_degree_heading * 2 + adder
 
         return heading
@@ -0,0 +1,723 @@
+# nxt.simsock module -- Simulated LEGO Mindstorms NXT brick and link
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Use to run nxt-python code without a brick. SimSock takes the place of
+USBSock or BlueSock and answers every telegram in nxt.telegram.OPCODES from
+a SimBrick, which models motors, sensor ports, i2c devices, mailboxes and
+the flash file system well enough for tests and benchmarks:
+
+    sock = SimSock('bluetooth')
+    brick = sock.connect()
+    sock.sim.sensors[PORT_1].raw = 300
+    brick.get_input_values(PORT_1)
+
+Replies arrive after a delay drawn from a LinkProfile, so timings (and the
+gain of pipelining, see Brick.batch) resemble those of the real link.
+"""
+
+import random
+from collections import deque
+from fnmatch import fnmatch
+from struct import Struct
+from threading import Lock
+from time import sleep, time
+
+from nxt.brick import Brick
+from nxt.motor import (PORT_ALL, MODE_MOTOR_ON, MODE_BRAKE, RUN_STATE_IDLE,
+    DEGREES_PER_POWER_SECOND)
+from nxt.sensor.common import Mode
+
+_U16 = Struct('<H')
+_U32 = Struct('<I')
+_FILENAME = Struct('<20s')
+_FILENAME_U32 = Struct('<20sI')
+_OUTPUT_STATE = Struct('<BbBBbBI')
+_OUTPUT_STATE_REPLY = Struct('<BbBBbBIiii')
+_INPUT_VALUES_REPLY = Struct('<BBBBBHHhh')
+_HANDLE_SIZE = Struct('<BI')
+_HANDLE_SIZE16 = Struct('<BH')
+_FIND_REPLY = Struct('<B20sI')
+_MODULE_REPLY = Struct('<B20sIIH')
+_IO_MAP = Struct('<IHH')
+_IO_MAP_REPLY = Struct('<IH')
+_DEVICE_INFO_REPLY = Struct('<15s7BII')
+
+# Status codes, see nxt.error.CODES
+SUCCESS = 0x00
+PENDING = 0x20
+MAILBOX_EMPTY = 0x40
+NO_MORE_HANDLES = 0x81
+NO_SPACE = 0x82
+END_OF_FILE = 0x85
+FILE_NOT_FOUND = 0x87
+HANDLE_CLOSED = 0x88
+FILE_IS_FULL = 0x8E
+FILE_EXISTS = 0x8F
+MODULE_NOT_FOUND = 0x90
+ILLEGAL_HANDLE = 0x93
+UNKNOWN_OPCODE = 0xBE
+BUS_ERROR = 0xDD
+NOT_CONFIGURED = 0xE0
+NO_PROGRAM = 0xEC
+BAD_ARGUMENTS = 0xFF
+
+FLASH_SIZE = 128 * 1024
+MAILBOX_DEPTH = 5 # messages an inbox holds before the oldest is dropped
+I2C_BYTE_TIME = 0.001 # transfer time of one byte on a low speed port
+
+# (name, id, size, iomap size) of the firmware modules
+MODULES = [
+    ('Command.mod', 0x00010001, 0, 0x0338),
+    ('Output.mod', 0x00020001, 0, 0x0060),
+    ('Input.mod', 0x00030001, 0, 0x0090),
+    ('Button.mod', 0x00040001, 0, 0x0020),
+    ('Comm.mod', 0x00050001, 0, 0x05E4),
+    ('IOCtrl.mod', 0x00060001, 0, 0x0004),
+    ('Sound.mod', 0x00080001, 0, 0x0040),
+    ('Loader.mod', 0x00090001, 0, 0x0006),
+    ('Display.mod', 0x000A0001, 0, 0x0350),
+    ('LowSpeed.mod', 0x000B0001, 0, 0x0097),
+    ('Ui.mod', 0x000C0001, 0, 0x0024),
+]
+
+
+class LinkProfile(object):
+    """Timing of a simulated link. Every reply arrives round_trip seconds
+    (give or take up to jitter) after its command was sent, but no sooner
+    than command_time after the previous reply, as the brick handles one
+    command at a time.
+    """
+    def __init__(self, round_trip, jitter=0, command_time=0):
+        self.round_trip = round_trip
+        self.jitter = jitter
+        self.command_time = command_time
+
+    def delay(self, rand):
+        return max(0, self.round_trip + rand.uniform(-self.jitter,
+                                                     self.jitter))
+
+PROFILES = {
+    'instant': LinkProfile(0),
+    'usb': LinkProfile(0.002, 0.0005, 0.0005),
+    'bluetooth': LinkProfile(0.035, 0.015, 0.001),
+}
+
+
+class SimMotor(object):
+    'State of a simulated output port'
+    def __init__(self):
+        self.power = 0
+        self.mode = 0
+        self.regulation = 0
+        self.turn_ratio = 0
+        self.run_state = RUN_STATE_IDLE
+        self.tacho_limit = 0
+        self.tacho_count = 0
+        self.block_tacho_count = 0
+        self.rotation_count = 0
+        self._moved = 0 # since the tacho limit was set
+        self._updated = time()
+
+    def update(self, now):
+        'Turns the motor as far as it got since the last update'
+        elapsed = now - self._updated
+        self._updated = now
+        if not (self.mode & MODE_MOTOR_ON and self.run_state and self.power):
+            return
+        step = int(round(abs(self.power) * DEGREES_PER_POWER_SECOND *
+                         elapsed))
+        if self.tacho_limit:
+            step = min(step, self.tacho_limit - self._moved)
+        self._moved += step
+        if self.power < 0:
+            step = -step
+        self.tacho_count += step
+        self.block_tacho_count += step
+        self.rotation_count += step
+        if self.tacho_limit and self._moved >= self.tacho_limit:
+            self.run_state = RUN_STATE_IDLE
+            if not self.mode & MODE_BRAKE:
+                self.power = 0
+
+    def set_state(self, power, mode, regulation, turn_ratio, run_state,
+                  tacho_limit):
+        (self.power, self.mode, self.regulation, self.turn_ratio,
+            self.run_state, self.tacho_limit) = (power, mode, regulation,
+            turn_ratio, run_state, tacho_limit)
+        self._moved = 0
+
+
+class SimSensor(object):
+    """State of a simulated input port. raw is the A/D value (0-1023); set
+    scaled to report a value other than the one derived from raw and the mode
+    (e.g. the color number of a color sensor).
+    """
+    def __init__(self):
+        self.sensor_type = 0
+        self.mode = 0
+        self.raw = 1023
+        self.scaled = None
+        self.i2c = None
+
+    def get_scaled(self):
+        if self.scaled is not None:
+            return self.scaled
+        mode = self.mode & Mode.MASK
+        if mode == Mode.BOOLEAN:
+            return int(self.raw < 512)
+        if mode == Mode.PCT_FULL_SCALE:
+            return (1023 - self.raw) * 100 // 1023
+        return self.raw
+
+
+class SimI2CDevice(object):
+    """A simulated digital sensor: 256 registers behind the i2c address
+    address. Register values are kept as a list of byte values.
+    """
+    def __init__(self, version='V1.0', product_id='LEGO',
+                 sensor_type='Sonar', address=0x02):
+        self.address = address
+        self.registers = [0] * 256
+        for offset, text in ((0x00, version), (0x08, product_id),
+                             (0x10, sensor_type)):
+            self.write(offset, text[:8])
+
+    def write(self, register, data):
+        for i, char in enumerate(data):
+            self.registers[(register + i) & 0xFF] = ord(char)
+
+    def read(self, register, n_bytes):
+        return ''.join(chr(self.registers[(register + i) & 0xFF])
+                       for i in range(n_bytes))
+
+
+class _Handle(object):
+    def __init__(self, kind, name, size=0):
+        self.kind = kind # 'r', 'w', 'find' or 'module'
+        self.name = name
+        self.size = size
+        self.pos = 0
+        self.data = []
+        self.matches = []
+
+
+class SimBrick(object):
+    """The simulated brick behind a SimSock. Its state may be inspected and
+    changed directly: motors (3 SimMotors), sensors (4 SimSensors), files
+    (name to contents), mailboxes (inboxes 0-9 are written by the computer,
+    10-19 read by it) and program, a function called with (brick, inbox,
+    message) for every message_write, standing in for the program running
+    on the brick.
+    """
+    def __init__(self, name='NXT', address='00:16:53:00:00:00'):
+        self.name = name
+        self.address = address
+        self.battery = 7800
+        self.sleep_time = 600000
+        self.firmware = ((1, 124), (1, 29))
+        self.motors = [SimMotor() for port in range(3)]
+        self.sensors = [SimSensor() for port in range(4)]
+        self.files = {}
+        self.mailboxes = [deque(maxlen=MAILBOX_DEPTH) for box in range(20)]
+        self.program = None
+        self.running_program = None
+        self.io_maps = dict((mod_id, ['\0'] * iomap_size) for
+                            (mname, mod_id, size, iomap_size) in MODULES)
+        self.commands = {} # opcode to number of commands received
+        self.lock = Lock()
+        self._handles = {}
+        self._i2c = {} # port to (data, ready time)
+
+    def add_i2c_device(self, port, device=None):
+        'Connects a SimI2CDevice (an ultrasonic sensor by default) to port'
+        if device is None:
+            device = SimI2CDevice()
+        self.sensors[port].i2c = device
+        return device
+
+    def flash_free(self):
+        return FLASH_SIZE - sum(len(data) for data in self.files.values())
+
+    def handle(self, pkt):
+        """Executes the telegram pkt. Returns the reply packet, or None if no
+        reply was requested.
+        """
+        typ, opcode = ord(pkt[0]), ord(pkt[1])
+        with self.lock:
+            self.commands[opcode] = self.commands.get(opcode, 0) + 1
+            handler = _HANDLERS.get(opcode)
+            if handler is None:
+                status, payload = UNKNOWN_OPCODE, ''
+            else:
+                try:
+                    status, payload = handler(self, pkt[2:])
+                except Exception: # a malformed telegram
+                    status, payload = BAD_ARGUMENTS, ''
+        if typ & 0x80:
+            return None
+        if opcode in (0xA1, 0xA2):
+            # the buffer number comes before the status in these replies
+            return '\x02' + chr(opcode) + payload[0] + chr(status) + \
+                payload[1:]
+        return '\x02' + chr(opcode) + chr(status) + payload
+
+    # direct commands
+
+    def _start_program(self, data):
+        fname = _fname(data)
+        if fname not in self.files:
+            return FILE_NOT_FOUND, ''
+        self.running_program = fname
+        return SUCCESS, ''
+
+    def _stop_program(self, data):
+        if self.running_program is None:
+            return NO_PROGRAM, ''
+        self.running_program = None
+        return SUCCESS, ''
+
+    def _play_sound_file(self, data):
+        if _fname(data[1:]) not in self.files:
+            return FILE_NOT_FOUND, ''
+        return SUCCESS, ''
+
+    def _success(self, data):
+        return SUCCESS, ''
+
+    def _set_output_state(self, data):
+        values = _OUTPUT_STATE.unpack(data[:_OUTPUT_STATE.size])
+        port = values[0]
+        if port == PORT_ALL:
+            motors = self.motors
+        elif port < 3:
+            motors = [self.motors[port]]
+        else:
+            return BAD_ARGUMENTS, ''
+        now = time()
+        for motor in motors:
+            motor.update(now)
+            motor.set_state(*values[1:])
+        return SUCCESS, ''
+
+    def _set_input_mode(self, data):
+        port, sensor_type, mode = ord(data[0]), ord(data[1]), ord(data[2])
+        if port > 3:
+            return BAD_ARGUMENTS, ''
+        self.sensors[port].sensor_type = sensor_type
+        self.sensors[port].mode = mode
+        return SUCCESS, ''
+
+    def _get_output_state(self, data):
+        port = ord(data[0])
+        if port > 2:
+            return BAD_ARGUMENTS, ''
+        m = self.motors[port]
+        m.update(time())
+        return SUCCESS, _OUTPUT_STATE_REPLY.pack(port, m.power, m.mode,
+            m.regulation, m.turn_ratio, m.run_state, m.tacho_limit,
+            m.tacho_count, m.block_tacho_count, m.rotation_count)
+
+    def _get_input_values(self, data):
+        port = ord(data[0])
+        if port > 3:
+            return BAD_ARGUMENTS, ''
+        s = self.sensors[port]
+        return SUCCESS, _INPUT_VALUES_REPLY.pack(port, 1, 0, s.sensor_type,
+            s.mode, s.raw, s.raw, s.get_scaled(), s.raw)
+
+    def _message_write(self, data):
+        inbox, size = ord(data[0]), ord(data[1])
+        if inbox > 9:
+            return BAD_ARGUMENTS, ''
+        message = data[2:2 + size].rstrip('\0')
+        self.mailboxes[inbox].append(message)
+        if self.program is not None:
+            self.program(self, inbox, message)
+        return SUCCESS, ''
+
+    def _reset_motor_position(self, data):
+        port, relative = ord(data[0]), ord(data[1])
+        if port > 2:
+            return BAD_ARGUMENTS, ''
+        motor = self.motors[port]
+        motor.update(time())
+        if relative:
+            motor.block_tacho_count = 0
+        else:
+            motor.rotation_count = 0
+        return SUCCESS, ''
+
+    def _get_battery_level(self, data):
+        return SUCCESS, _U16.pack(self.battery)
+
+    def _keep_alive(self, data):
+        return SUCCESS, _U32.pack(self.sleep_time)
+
+    def _ls_get_status(self, data):
+        port = ord(data[0])
+        if port not in self._i2c:
+            return SUCCESS, '\0'
+        reply, ready = self._i2c[port]
+        if time() < ready:
+            return PENDING, '\0'
+        return SUCCESS, chr(len(reply))
+
+    def _ls_write(self, data):
+        port, tx_len, rx_len = ord(data[0]), ord(data[1]), ord(data[2])
+        tx = data[3:3 + tx_len]
+        if port > 3:
+            return BAD_ARGUMENTS, ''
+        device = self.sensors[port].i2c
+        if device is None or not tx or ord(tx[0]) != device.address:
+            return BUS_ERROR, ''
+        register = ord(tx[1]) if tx_len > 1 else 0
+        if rx_len:
+            reply = device.read(register, rx_len)
+        else:
+            device.write(register, tx[2:])
+            reply = ''
+        self._i2c[port] = (reply, time() + I2C_BYTE_TIME * (tx_len + rx_len))
+        return SUCCESS, ''
+
+    def _ls_read(self, data):
+        port = ord(data[0])
+        if port not in self._i2c:
+            return NOT_CONFIGURED, ''
+        reply, ready = self._i2c[port]
+        if time() < ready:
+            return PENDING, ''
+        del self._i2c[port]
+        return SUCCESS, chr(len(reply)) + reply.ljust(16, '\0')
+
+    def _get_current_program_name(self, data):
+        if self.running_program is None:
+            return NO_PROGRAM, ''
+        return SUCCESS, _FILENAME.pack(self.running_program)
+
+    def _message_read(self, data):
+        remote, local, remove = ord(data[0]), ord(data[1]), ord(data[2])
+        if remote > 19:
+            return BAD_ARGUMENTS, ''
+        box = self.mailboxes[remote]
+        if not box:
+            return MAILBOX_EMPTY, ''
+        message = box[0]
+        if remove:
+            box.popleft()
+        message += '\0'
+        return SUCCESS, chr(local) + chr(len(message)) + message.ljust(59,
+                                                                      '\0')
+
+    # system commands
+
+    def _new_handle(self, handle):
+        for n in range(256):
+            if n not in self._handles:
+                self._handles[n] = handle
+                return n
+        return None
+
+    def _get_handle(self, data, kinds):
+        handle = self._handles.get(ord(data[0]))
+        if handle is None or handle.kind not in kinds:
+            return None
+        return handle
+
+    def _open_read(self, data):
+        fname = _fname(data)
+        if fname not in self.files:
+            return FILE_NOT_FOUND, ''
+        handle = self._new_handle(_Handle('r', fname,
+                                          len(self.files[fname])))
+        if handle is None:
+            return NO_MORE_HANDLES, ''
+        return SUCCESS, _HANDLE_SIZE.pack(handle, len(self.files[fname]))
+
+    def _open_write(self, data):
+        fname, size = _FILENAME_U32.unpack(data[:_FILENAME_U32.size])
+        fname = fname.split('\0')[0]
+        if fname in self.files:
+            return FILE_EXISTS, ''
+        if size > self.flash_free():
+            return NO_SPACE, ''
+        handle = self._new_handle(_Handle('w', fname, size))
+        if handle is None:
+            return NO_MORE_HANDLES, ''
+        self.files[fname] = ''
+        return SUCCESS, chr(handle)
+
+    def _read(self, data):
+        n, n_bytes = _HANDLE_SIZE16.unpack(data[:_HANDLE_SIZE16.size])
+        handle = self._get_handle(data, ('r', ))
+        if handle is None:
+            return ILLEGAL_HANDLE, ''
+        contents = self.files[handle.name][handle.pos:handle.pos + n_bytes]
+        if not contents and n_bytes:
+            return END_OF_FILE, ''
+        handle.pos += len(contents)
+        return SUCCESS, _HANDLE_SIZE16.pack(n, len(contents)) + contents
+
+    def _write(self, data):
+        n = ord(data[0])
+        handle = self._get_handle(data, ('w', ))
+        if handle is None:
+            return ILLEGAL_HANDLE, ''
+        contents = data[1:]
+        if handle.pos + len(contents) > handle.size:
+            return FILE_IS_FULL, ''
+        handle.data.append(contents)
+        handle.pos += len(contents)
+        return SUCCESS, _HANDLE_SIZE16.pack(n, len(contents))
+
+    def _close(self, data):
+        n = ord(data[0])
+        handle = self._handles.pop(n, None)
+        if handle is None:
+            return HANDLE_CLOSED, ''
+        if handle.kind == 'w':
+            self.files[handle.name] += ''.join(handle.data)
+        return SUCCESS, chr(n)
+
+    def _delete(self, data):
+        fname = _fname(data)
+        if fname not in self.files:
+            return FILE_NOT_FOUND, ''
+        del self.files[fname]
+        return SUCCESS, _FILENAME.pack(fname)
+
+    def _find_first(self, data):
+        pattern = _fname(data)
+        matches = sorted(name for name in self.files if fnmatch(name,
+                         pattern))
+        if not matches:
+            return FILE_NOT_FOUND, ''
+        handle = _Handle('find', pattern)
+        handle.matches = matches
+        n = self._new_handle(handle)
+        if n is None:
+            return NO_MORE_HANDLES, ''
+        return self._find_next(chr(n))
+
+    def _find_next(self, data):
+        handle = self._get_handle(data, ('find', ))
+        if handle is None:
+            return ILLEGAL_HANDLE, ''
+        while handle.pos < len(handle.matches):
+            fname = handle.matches[handle.pos]
+            handle.pos += 1
+            if fname in self.files:
+                return SUCCESS, _FIND_REPLY.pack(ord(data[0]), fname,
+                                                 len(self.files[fname]))
+        return FILE_NOT_FOUND, ''
+
+    def _get_firmware_version(self, data):
+        (prot_major, prot_minor), (fw_major, fw_minor) = self.firmware
+        return SUCCESS, chr(prot_minor) + chr(prot_major) + chr(fw_minor) + \
+            chr(fw_major)
+
+    def _open_read_linear(self, data):
+        fname = _fname(data)
+        if fname not in self.files:
+            return FILE_NOT_FOUND, ''
+        # a made up flash address
+        return SUCCESS, _U32.pack(0x00108000 + sorted(self.files).index(
+            fname) * 0x100)
+
+    def _open_append_data(self, data):
+        fname = _fname(data)
+        if fname not in self.files:
+            return FILE_NOT_FOUND, ''
+        contents = self.files.pop(fname)
+        handle = _Handle('w', fname, len(contents) + self.flash_free())
+        handle.data.append(contents)
+        handle.pos = len(contents)
+        self.files[fname] = ''
+        n = self._new_handle(handle)
+        if n is None:
+            self.files[fname] = contents
+            return NO_MORE_HANDLES, ''
+        return SUCCESS, _HANDLE_SIZE.pack(n, self.flash_free())
+
+    def _request_first_module(self, data):
+        pattern = _fname(data)
+        handle = _Handle('module', pattern)
+        handle.matches = [module for module in MODULES
+                          if fnmatch(module[0], pattern)]
+        if not handle.matches:
+            return MODULE_NOT_FOUND, ''
+        n = self._new_handle(handle)
+        if n is None:
+            return NO_MORE_HANDLES, ''
+        return self._request_next_module(chr(n))
+
+    def _request_next_module(self, data):
+        handle = self._get_handle(data, ('module', ))
+        if handle is None:
+            return ILLEGAL_HANDLE, ''
+        if handle.pos >= len(handle.matches):
+            return MODULE_NOT_FOUND, ''
+        mname, mod_id, size, iomap_size = handle.matches[handle.pos]
+        handle.pos += 1
+        return SUCCESS, _MODULE_REPLY.pack(ord(data[0]), mname, mod_id, size,
+                                           iomap_size)
+
+    def _read_io_map(self, data):
+        mod_id, offset, n_bytes = _IO_MAP.unpack(data[:_IO_MAP.size])
+        io_map = self.io_maps.get(mod_id)
+        if io_map is None:
+            return MODULE_NOT_FOUND, ''
+        contents = ''.join(io_map[offset:offset + n_bytes])
+        return SUCCESS, _IO_MAP_REPLY.pack(mod_id, len(contents)) + contents
+
+    def _write_io_map(self, data):
+        mod_id, offset, n_bytes = _IO_MAP.unpack(data[:_IO_MAP.size])
+        io_map = self.io_maps.get(mod_id)
+        if io_map is None:
+            return MODULE_NOT_FOUND, ''
+        contents = data[_IO_MAP.size:_IO_MAP.size + n_bytes]
+        if offset + len(contents) > len(io_map):
+            return BAD_ARGUMENTS, ''
+        io_map[offset:offset + len(contents)] = list(contents)
+        return SUCCESS, _IO_MAP_REPLY.pack(mod_id, len(contents))
+
+    def _boot(self, data):
+        return SUCCESS, 'Yes\0'
+
+    def _set_brick_name(self, data):
+        self.name = data[:15].split('\0')[0]
+        return SUCCESS, ''
+
+    def _get_device_info(self, data):
+        address = [int(part, 16) for part in self.address.split(':')]
+        return SUCCESS, _DEVICE_INFO_REPLY.pack(self.name, *(address + [0, 0,
+            self.flash_free()]))
+
+    def _delete_user_flash(self, data):
+        self.files.clear()
+        return SUCCESS, ''
+
+    def _poll_command_length(self, data):
+        return SUCCESS, data[0] + '\0'
+
+    def _poll_command(self, data):
+        return SUCCESS, data[0] + '\0'
+
+
+def _fname(data):
+    return data[:20].split('\0')[0]
+
+_HANDLERS = {
+    0x00: SimBrick._start_program,
+    0x01: SimBrick._stop_program,
+    0x02: SimBrick._play_sound_file,
+    0x03: SimBrick._success, # play_tone
+    0x04: SimBrick._set_output_state,
+    0x05: SimBrick._set_input_mode,
+    0x06: SimBrick._get_output_state,
+    0x07: SimBrick._get_input_values,
+    0x08: SimBrick._success, # reset_input_scaled_value
+    0x09: SimBrick._message_write,
+    0x0A: SimBrick._reset_motor_position,
+    0x0B: SimBrick._get_battery_level,
+    0x0C: SimBrick._success, # stop_sound_playback
+    0x0D: SimBrick._keep_alive,
+    0x0E: SimBrick._ls_get_status,
+    0x0F: SimBrick._ls_write,
+    0x10: SimBrick._ls_read,
+    0x11: SimBrick._get_current_program_name,
+    0x13: SimBrick._message_read,
+    0x80: SimBrick._open_read,
+    0x81: SimBrick._open_write,
+    0x82: SimBrick._read,
+    0x83: SimBrick._write,
+    0x84: SimBrick._close,
+    0x85: SimBrick._delete,
+    0x86: SimBrick._find_first,
+    0x87: SimBrick._find_next,
+    0x88: SimBrick._get_firmware_version,
+    0x89: SimBrick._open_write, # open_write_linear
+    0x8A: SimBrick._open_read_linear,
+    0x8B: SimBrick._open_write, # open_write_data
+    0x8C: SimBrick._open_append_data,
+    0x90: SimBrick._request_first_module,
+    0x91: SimBrick._request_next_module,
+    0x92: SimBrick._close, # close_module_handle
+    0x94: SimBrick._read_io_map,
+    0x95: SimBrick._write_io_map,
+    0x97: SimBrick._boot,
+    0x98: SimBrick._set_brick_name,
+    0x9B: SimBrick._get_device_info,
+    0xA0: SimBrick._delete_user_flash,
+    0xA1: SimBrick._poll_command_length,
+    0xA2: SimBrick._poll_command,
+    0xA4: SimBrick._success, # bluetooth_factory_reset
+}
+
+
+class SimSock(object):
+    """A socket talking to a SimBrick (a new one if sim is None). profile is
+    a LinkProfile or the name of one in PROFILES; 'usb' and 'bluetooth' also
+    make the socket report that type and block size, so code tuned per
+    connection type behaves as on that link. seed makes the jitter
+    repeatable.
+    """
+
+    pipeline_depth = 4  # replies which may be outstanding in a Batch
+
+    def __init__(self, profile='instant', sim=None, seed=None):
+        if sim is None:
+            sim = SimBrick()
+        self.sim = sim
+        if isinstance(profile, basestring):
+            self.type = profile if profile in ('usb', 'bluetooth') else 'sim'
+            profile = PROFILES[profile]
+        else:
+            self.type = 'sim'
+        self.profile = profile
+        self.bsize = 118 if self.type == 'bluetooth' else 58
+        self.debug = False
+        self._random = random.Random(seed)
+        self._replies = deque()
+        self._last_ready = 0
+
+    def __str__(self):
+        return 'Simulator (%s)' % self.sim.name
+
+    def connect(self):
+        return Brick(self)
+
+    def close(self):
+        self._replies.clear()
+
+    def send(self, data):
+        if self.debug:
+            print 'Send:',
+            print ':'.join('%02x' % ord(c) for c in data)
+        reply = self.sim.handle(data)
+        if reply is None:
+            return
+        ready = max(time() + self.profile.delay(self._random),
+                    self._last_ready + self.profile.command_time)
+        self._last_ready = ready
+        self._replies.append((ready, reply))
+
+    def recv(self):
+        if not self._replies:
+            raise IOError('No reply expected')
+        ready, data = self._replies.popleft()
+        wait = ready - time()
+        if wait > 0:
+            sleep(wait)
+        if self.debug:
+            print 'Recv:',
+            print ':'.join('%02x' % ord(c) for c in data)
+        return data
@@ -14,6 +14,20 @@
 
 'Use for communications regarding the NXT filesystem and such ***ADVANCED USERS ONLY***'
 
+from nxt.utils import layout
+
+# Precompiled request and reply layouts, so that fixed-size telegrams are
+# packed and parsed with a single struct call.
+_HANDLE_SIZE = layout('BI')
+_HANDLE_SIZE16 = layout('BH')
+_FIND_REPLY = layout('B20sI')
+_FIRMWARE_VERSION_REPLY = layout('BBBB')
+_MODULE_REPLY = layout('B20sIIH')
+_IO_MAP = layout('IHH')
+_IO_MAP_REPLY = layout('IH')
+_DEVICE_INFO_REPLY = layout('15s7BII')
+_POLL_COMMAND = layout('BB')
+
 def _create(opcode):
     'Create a simple system telegram'
     from telegram import Telegram
@@ -34,9 +48,7 @@ def open_read(opcode, fname):
 
 def _parse_open_read(tgram):
     tgram.check_status()
-    handle = tgram.parse_u8()
-    n_bytes = tgram.parse_u32()
-    return (handle, n_bytes)
+    return tgram.parse_struct(_HANDLE_SIZE)
 
 def open_write(opcode, fname, n_bytes):
     tgram = _create_with_file(opcode, fname)
@@ -49,14 +61,13 @@ def _parse_open_write(tgram):
     return handle
 
 def read(opcode, handle, n_bytes):
-    tgram = _create_with_handle(opcode, handle)
-    tgram.add_u16(n_bytes)
+    tgram = _create(opcode)
+    tgram.add_struct(_HANDLE_SIZE16, handle, n_bytes)
     return tgram
 
 def _parse_read(tgram):
     tgram.check_status()
-    handle = tgram.parse_u8()
-    n_bytes = tgram.parse_u16()
+    handle, n_bytes = tgram.parse_struct(_HANDLE_SIZE16)
     data = tgram.parse_string()
     return (handle, n_bytes, data)
 
@@ -67,9 +78,7 @@ def write(opcode, handle, data):
 
 def _parse_write(tgram):
     tgram.check_status()
-    handle = tgram.parse_u8()
-    n_bytes = tgram.parse_u16()
-    return (handle, n_bytes)
+    return tgram.parse_struct(_HANDLE_SIZE16)
 
 def close(opcode, handle):
     return _create_with_handle(opcode, handle)
@@ -93,10 +102,7 @@ def find_first(opcode, fname):
 
 def _parse_find(tgram):
     tgram.check_status()
-    handle = tgram.parse_u8()
-    fname = tgram.parse_string(20)
-    n_bytes = tgram.parse_u32()
-    return (handle, fname, n_bytes)
+    return tgram.parse_struct(_FIND_REPLY)
 
 def find_next(opcode, handle):
     return _create_with_handle(opcode, handle)
@@ -106,11 +112,9 @@ def get_firmware_version(opcode):
 
 def _parse_get_firmware_version(tgram):
     tgram.check_status()
-    prot_minor = tgram.parse_u8()
-    prot_major = tgram.parse_u8()
+    prot_minor, prot_major, fw_minor, fw_major = \
+        tgram.parse_struct(_FIRMWARE_VERSION_REPLY)
     prot_version = (prot_major, prot_minor)
-    fw_minor = tgram.parse_u8()
-    fw_major = tgram.parse_u8()
     fw_version = (fw_major, fw_minor)
     return (prot_version, fw_version)
 
@@ -137,21 +141,15 @@ def open_append_data(opcode, fname):
 
 def _parse_open_append_data(tgram):
     tgram.check_status()
-    handle = tgram.parse_u8()
-    n_bytes = tgram.parse_u32()
-    return (handle, n_bytes)
+    return tgram.parse_struct(_HANDLE_SIZE)
 
 def request_first_module(opcode, mname):
     return _create_with_file(opcode, mname)
 
 def _parse_request_module(tgram):
     tgram.check_status()
-    handle = tgram.parse_u8()
-    mname = tgram.parse_string(20)
-    mod_id = tgram.parse_u32()
-    mod_size = tgram.parse_u32()
-    mod_iomap_size = tgram.parse_u16()
-    return (handle, mname, mod_id, mod_size, mod_iomap_size)
+    # (handle, mname, mod_id, mod_size, mod_iomap_size)
+    return tgram.parse_struct(_MODULE_REPLY)
 
 def request_next_module(opcode, handle):
     return _create_with_handle(opcode, handle)
@@ -161,31 +159,24 @@ def close_module_handle(opcode, handle):
 
 def read_io_map(opcode, mod_id, offset, n_bytes):
     tgram = _create(opcode)
-    tgram.add_u32(mod_id)
-    tgram.add_u16(offset)
-    tgram.add_u16(n_bytes)
+    tgram.add_struct(_IO_MAP, mod_id, offset, n_bytes)
     return tgram
 
 def _parse_read_io_map(tgram):
     tgram.check_status()
-    mod_id = tgram.parse_u32()
-    n_bytes = tgram.parse_u16()
+    mod_id, n_bytes = tgram.parse_struct(_IO_MAP_REPLY)
     contents = tgram.parse_string()
     return (mod_id, n_bytes, contents)
 
 def write_io_map(opcode, mod_id, offset, content):
     tgram = _create(opcode)
-    tgram.add_u32(mod_id)
-    tgram.add_u16(offset)
-    tgram.add_u16(len(content))
+    tgram.add_struct(_IO_MAP, mod_id, offset, len(content))
     tgram.add_string(len(content), content)
     return tgram
 
 def _parse_write_io_map(tgram):
     tgram.check_status()
-    mod_id = tgram.parse_u32()
-    n_bytes = tgram.parse_u16()
-    return (mod_id, n_bytes)
+    return tgram.parse_struct(_IO_MAP_REPLY)
 
 def boot(opcode):
     # Note: this command is USB only (no Bluetooth)
@@ -217,18 +208,10 @@ def get_device_info(opcode):
 
 def _parse_get_device_info(tgram):
     tgram.check_status()
-    name = tgram.parse_string(15)
-    a0 = tgram.parse_u8()
-    a1 = tgram.parse_u8()
-    a2 = tgram.parse_u8()
-    a3 = tgram.parse_u8()
-    a4 = tgram.parse_u8()
-    a5 = tgram.parse_u8()
-    a6 = tgram.parse_u8()
+    (name, a0, a1, a2, a3, a4, a5, a6, signal_strength,
+        user_flash) = tgram.parse_struct(_DEVICE_INFO_REPLY)
     # FIXME: what is a6 for?
     address = '%02X:%02X:%02X:%02X:%02X:%02X' % (a0, a1, a2, a3, a4, a5)
-    signal_strength = tgram.parse_u32()
-    user_flash = tgram.parse_u32()
     return (name, address, signal_strength, user_flash)
 
 def delete_user_flash(opcode):
@@ -250,8 +233,7 @@ def _parse_poll_command_length(tgram):
 
 def poll_command(opcode, buf_num, n_bytes):
     tgram = _create(opcode)
-    tgram.add_u8(buf_num)
-    tgram.add_u8(n_bytes)
+    tgram.add_struct(_POLL_COMMAND, buf_num, n_bytes)
     return tgram
 
 def _parse_poll_command(tgram):
@@ -14,9 +14,8 @@
 
 'Used by nxt.system for sending telegrams to the NXT'
 
-from cStringIO import StringIO
-from struct import pack, unpack
 import nxt.error
+from nxt.utils import layout
 
 class InvalidReplyError(Exception):
     pass
@@ -24,6 +23,15 @@ class InvalidReplyError(Exception):
 class InvalidOpcodeError(Exception):
     pass
 
+_HEADER = layout('BB')
+_S8 = layout('b')
+_U8 = layout('B')
+_S16 = layout('h')
+_U16 = layout('H')
+_S32 = layout('i')
+_U32 = layout('I')
+_FILENAME = layout('20s')
+
 class Telegram(object):
 
     TYPE = 0    # type byte offset
@@ -37,78 +45,101 @@ class Telegram(object):
     def __init__(self, direct=False, opcode=0, reply_req=True, pkt=None):
         self.reply = True
         if pkt:
-            self.pkt = StringIO(pkt)
-            self.typ = self.parse_u8()
-            self.opcode = self.parse_u8()
+            self.parts = None   # an incoming telegram is only parsed
+            self.pkt = pkt
+            self.pos = 0
+            self.typ, self.opcode = self.parse_struct(_HEADER)
             if not self.is_reply():
                 raise InvalidReplyError
             if self.opcode != opcode:
                 raise InvalidOpcodeError, self.opcode
         else:
-            self.pkt = StringIO()
             typ = 0
             if not direct:
                 typ |= Telegram.TYPE_NOT_DIRECT
             if not reply_req:
                 typ |= Telegram.TYPE_REPLY_NOT_REQUIRED
                 self.reply = False
-            self.add_u8(typ)
-            self.add_u8(opcode)
+            self.typ = typ
+            self.opcode = opcode
+            self.parts = [_HEADER.pack(typ, opcode)]
 
     def __str__(self):
-        return self.pkt.getvalue()
+        if self.parts is None:
+            return self.pkt
+        return ''.join(self.parts)
+
+    def set_reply(self, reply_req):
+        'Sets whether a reply is requested for an outgoing telegram'
+        typ = self.typ & ~Telegram.TYPE_REPLY_NOT_REQUIRED
+        if not reply_req:
+            typ |= Telegram.TYPE_REPLY_NOT_REQUIRED
+        self.typ = typ
+        self.reply = bool(reply_req)
+        self.parts[0] = _HEADER.pack(typ, self.opcode)
 
     def is_reply(self):
         return self.typ == Telegram.TYPE_REPLY
 
+    def add_struct(self, layout, *values):
+        'Packs several fields at once using a precompiled struct.Struct'
+        self.parts.append(layout.pack(*values))
+
     def add_string(self, n_bytes, v):
-        self.pkt.write(pack('%ds' % n_bytes, v))
+        self.parts.append(layout('%ds' % n_bytes).pack(v))
 
     def add_filename(self, fname):
-        self.pkt.write(pack('20s', fname))
+        self.parts.append(_FILENAME.pack(fname))
 
     def add_s8(self, v):
-        self.pkt.write(pack('<b', v))
+        self.parts.append(_S8.pack(v))
 
     def add_u8(self, v):
-        self.pkt.write(pack('<B', v))
+        self.parts.append(_U8.pack(v))
 
     def add_s16(self, v):
-        self.pkt.write(pack('<h', v))
+        self.parts.append(_S16.pack(v))
 
     def add_u16(self, v):
-        self.pkt.write(pack('<H', v))
+        self.parts.append(_U16.pack(v))
 
     def add_s32(self, v):
-        self.pkt.write(pack('<i', v))
+        self.parts.append(_S32.pack(v))
 
     def add_u32(self, v):
-        self.pkt.write(pack('<I', v))
+        self.parts.append(_U32.pack(v))
+
+    def parse_struct(self, layout):
+        'Unpacks several fields at once using a precompiled struct.Struct'
+        values = layout.unpack_from(self.pkt, self.pos)
+        self.pos += layout.size
+        return values
 
     def parse_string(self, n_bytes=0):
         if n_bytes:
-            return unpack('%ss' % n_bytes,
-                self.pkt.read(n_bytes))[0]
+            return self.parse_struct(layout('%ds' % n_bytes))[0]
         else:
-            return self.pkt.read()
+            data = self.pkt[self.pos:]
+            self.pos = len(self.pkt)
+            return data
 
     def parse_s8(self):
-        return unpack('<b', self.pkt.read(1))[0]
+        return self.parse_struct(_S8)[0]
 
     def parse_u8(self):
-        return unpack('<B', self.pkt.read(1))[0]
+        return self.parse_struct(_U8)[0]
 
     def parse_s16(self):
-        return unpack('<h', self.pkt.read(2))[0]
+        return self.parse_struct(_S16)[0]
 
     def parse_u16(self):
-        return unpack('<H', self.pkt.read(2))[0]
+        return self.parse_struct(_U16)[0]
 
     def parse_s32(self):
-        return unpack('<i', self.pkt.read(4))[0]
+        return self.parse_struct(_S32)[0]
 
     def parse_u32(self):
-        return unpack('<I', self.pkt.read(4))[0]
+        return self.parse_struct(_U32)[0]
 
     def check_status(self):
         nxt.error.check_status(self.parse_u8())
@@ -14,6 +14,7 @@
 # GNU General Public License for more details.
 
 import usb, os
+from array import array
 from nxt.brick import Brick
 
 ID_VENDOR_LEGO = 0x0694
@@ -27,17 +28,23 @@ NXT_INTERFACE     = 0
 
 TIMEOUT = 250
 
+PACKET_SIZE = 64
+
 class USBSock(object):
     'Object for USB connection to NXT'
 
+    bsize = 58  # USB file block size, replies must fit in one packet
     type = 'usb'
+    pipeline_depth = 4  # replies which may be outstanding in a Batch
 
     def __init__(self, device):
         self.device = device
         self.debug = False
+        self._buffer = array('B', '\0' * PACKET_SIZE)
 
     def __str__(self):
-        return 'USB (%s)' % (self.device.filename)
+        return 'USB (bus %s, address %s)' % (self.device.bus,
+                                              self.device.address)
 
     def _debug(self, message, err=''):
         if self.debug:
@@ -50,6 +57,8 @@ class USBSock(object):
             if os.name != 'nt' and self.device.is_kernel_driver_active(NXT_INTERFACE):
                 self.device.detach_kernel_driver(NXT_INTERFACE)
             self.device.set_configuration(NXT_CONFIGURATION)
+            self._out = self.device.bind_endpoint(OUT_ENDPOINT)
+            self._in = self.device.bind_endpoint(IN_ENDPOINT)
         except Exception, err:
             self._debug('ERROR:usbsock:connect', err)
             raise
@@ -60,24 +69,34 @@ class USBSock(object):
         'Use to close the connection.'
         self._debug('Closing USB connection...')
         self.device = None
+        self._out = self._in = None
         self._debug('USB connection closed.')
 
     def send(self, data):
         'Use to send raw data over USB connection'
         #self._debug('Send:')
         #self._debug(':'.join('%02x' % ord(c) for c in data))
-        self.device.write(OUT_ENDPOINT, data, TIMEOUT)
+        self._out.write(data, TIMEOUT)
 
     def recv(self):
         'Use to recieve raw data over USB connection'
-        data = self.device.read(IN_ENDPOINT, 64, TIMEOUT)
+        n_bytes = self._in.read_into(self._buffer, TIMEOUT)
         #self._debug('Recv:')
-        #self._debug(':'.join('%02x' % (c & 0xFF) for c in data))
-        # NOTE: bulkRead returns a tuple of ints ... make it sane
-        return ''.join(chr(d & 0xFF) for d in data)
+        #self._debug(':'.join('%02x' % c for c in self._buffer[:n_bytes]))
+        # NOTE: the buffer is reused by the next read, and replies may be
+        # kept around (see Brick.batch), so hand back a copy of the reply
+        # only, taken in one go through a buffer object.
+        return buffer(self._buffer, 0, n_bytes)[:]
 
 def find_bricks(host=None, name=None):
     'Use to look for NXTs connected by USB only'
     for device in usb.core.find(find_all=True, idVendor=ID_VENDOR_LEGO, idProduct=ID_PRODUCT_NXT):
         yield USBSock(device)
 
+
+def find_brick_at(bus, address):
+    'Use to get the NXT at a known USB bus and device address, or None'
+    device = usb.core.find(idVendor=ID_VENDOR_LEGO, idProduct=ID_PRODUCT_NXT,
+        bus=bus, address=address)
+    if device is not None:
+        return USBSock(device)
@@ -12,6 +12,8 @@
 # GNU General Public License for more details.
 
 from collections import defaultdict
+from struct import Struct
+from threading import Event, Lock
 
 def parse_command_line_arguments(arguments):
     keyword_parameters = defaultdict(lambda: None)
@@ -31,3 +33,76 @@ def parse_command_line_arguments(arguments):
                 parameters.append(argument)
     return parameters, keyword_parameters
 
+
+_layouts = {}
+
+def layout(fmt):
+    """Returns a precompiled little-endian struct.Struct for the given format.
+    Layouts are cached, so calling this repeatedly with the same format string
+    is cheap and always returns the same object.
+    """
+    try:
+        return _layouts[fmt]
+    except KeyError:
+        s = _layouts[fmt] = Struct('<' + fmt)
+        return s
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    """The result of an operation carried out by another thread. Use
+    result() to wait for it, or add_done_callback() to be called (from the
+    thread which completes it) once it is available.
+    """
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) and returns the
+        exception raised by the operation, or None if it succeeded.
+        """
+        self._event.wait(timeout)
+        if not self._event.is_set():
+            raise TimeoutError('Operation did not complete in time')
+        return self._exception
+
+    def result(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) and returns the
+        result of the operation, raising its exception if it failed.
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
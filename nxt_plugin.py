@@ -44,11 +44,15 @@ from TurtleArt.tatype import TYPE_INT, TYPE_STRING, TYPE_NUMBER
 sys.path.insert(0, os.path.abspath('./plugins/nxt_plugin'))
 import usb
 from nxt.motor import PORT_A, PORT_B, PORT_C, Motor, SynchronizedMotors
+from nxt.motor import PORT_ALL, MODE_IDLE, REGULATION_IDLE, RUN_STATE_IDLE
+from nxt.brick import broadcast
 from nxt.sensor import PORT_1, PORT_2, PORT_3, PORT_4
 from nxt.sensor import Touch, Color20, Ultrasonic, Type, Sound, Light
 from nxt.sensor import HTCompass
 from nxt.usbsock import USBSock, ID_VENDOR_LEGO, ID_PRODUCT_NXT
 from nxt.bluesock import BlueSock
+from nxt.utils import Future, TimeoutError
+from threading import Thread, Event
 try:
     import bluetooth
 except:
@@ -56,6 +60,8 @@ except:
 
 NXT_MOTOR_PORTS = {'A': PORT_A, 'B': PORT_B, 'C': PORT_C}
 NXT_SENSOR_PORTS = {1: PORT_1, 2: PORT_2, 3: PORT_3, 4: PORT_4}
+# seconds stop() waits for a cancelled move to return
+MOVE_STOP_TIMEOUT = 2
 NXT_SENSORS = [_('button'), _('distance'), _('color'), _('light'), _('sound'), _('gray')]
 
 colors = [None, BLACK, CONSTANTS['blue'], CONSTANTS['green'], CONSTANTS['yellow'], CONSTANTS['red'], WHITE]
@@ -86,6 +92,10 @@ class Nxt_plugin(Plugin):
         self._bricks = []
         self.active_nxt = 0
         self._motor_pos = {}
+        self._sensors = {}
+        self._motors = {}
+        self._moves = {}
+        self._cancel = Event()
 
     def setup(self):
 
@@ -196,6 +206,33 @@ class Nxt_plugin(Plugin):
                                           [3, ['number', 100], 0, 0, [0, None]]
                                          ]
 
+        palette_motors.add_block('nxtstartturnmotor',
+                  style='basic-style-3arg',
+                  label=[_('start turning motor %s') % '\n\n', _('port'),
+                         _('rotations'), _('power')],
+                  default=['A', 1, 100],
+                  help_string=_('Start turning a motor, and continue with the program while it turns.'),
+                  prim_name='nxtstartturnmotor')
+        self.tw.lc.def_prim('nxtstartturnmotor', 3,
+            Primitive(self.startturnmotor, arg_descs=[ArgSlot(TYPE_STRING), ArgSlot(TYPE_NUMBER), ArgSlot(TYPE_NUMBER)]))
+
+        palette_motors.add_block('nxtstartsyncmotors',
+                  style='basic-style-2arg',
+                  label=[_('start synchronizing %s motors') % SYNC_STRING1, _('power'), _('rotations')],
+                  default=[100, 1],
+                  help_string=_('Start turning the motors in PORT B and PORT C together, and continue with the program while they turn.'),
+                  prim_name='nxtstartsyncmotors')
+        self.tw.lc.def_prim('nxtstartsyncmotors', 2,
+            Primitive(self.startsyncmotors, arg_descs=[ArgSlot(TYPE_NUMBER), ArgSlot(TYPE_NUMBER)]))
+
+        palette_motors.add_block('nxtwaitmotors',
+                  style='basic-style',
+                  label=_('wait for motors'),
+                  help_string=_('Wait until the motors started on all NXTs have finished turning.'),
+                  prim_name='nxtwaitmotors')
+        self.tw.lc.def_prim('nxtwaitmotors', 0,
+            Primitive(self.waitmotors))
+
         palette_motors.add_block('nxtmotorreset',
                   style='basic-style-1arg',
                   label=_('reset motor'),
@@ -312,15 +349,23 @@ class Nxt_plugin(Plugin):
     ############################### Turtle signals ############################
 
     def stop(self):
+        self._cancel_moves()
         self._idle_motors()
 
     def quit(self):
+        self._cancel_moves()
         self._idle_motors()
         self._close_bricks()
 
     ################################# Primitives ##############################
 
     def turnmotor(self, port, turns, power):
+        self._turnmotor(port, turns, power, True)
+
+    def startturnmotor(self, port, turns, power):
+        self._turnmotor(port, turns, power, False)
+
+    def _turnmotor(self, port, turns, power, wait):
         if self._bricks:
             port = str(port)
             port_up = port.upper()
@@ -331,11 +376,14 @@ class Nxt_plugin(Plugin):
                         turns = abs(turns)
                         power = -1 * power
                     try:
-                        m = Motor(self._bricks[self.active_nxt], port)
-                        m.turn(power, int(turns*360), brake=True)
-                        m.brake()
+                        m = self._get_motor(port)
                     except:
                         raise logoerror(ERROR_GENERIC)
+                    key = (self.active_nxt, port)
+                    self._start_move([key], self._turn, m, power,
+                                     int(turns*360))
+                    if wait:
+                        self._wait_moves([key])
                 else:
                     raise logoerror(ERROR_POWER)
             else:
@@ -344,18 +392,27 @@ class Nxt_plugin(Plugin):
             raise logoerror(ERROR_BRICK)
 
     def syncmotors(self, power, turns):
+        self._syncmotors(power, turns, True)
+
+    def startsyncmotors(self, power, turns):
+        self._syncmotors(power, turns, False)
+
+    def _syncmotors(self, power, turns, wait):
         if self._bricks:
             if not((power < -127) or (power > 127)):
                 if turns < 0:
                     turns = abs(turns)
                     power = -1 * power
                 try:
-                    motorB = Motor(self._bricks[self.active_nxt], PORT_B)
-                    motorC = Motor(self._bricks[self.active_nxt], PORT_C)
+                    motorB = self._get_motor(PORT_B)
+                    motorC = self._get_motor(PORT_C)
                     syncmotors = SynchronizedMotors(motorB, motorC, 0)
-                    syncmotors.turn(power, int(turns*360))
                 except:
                     raise logoerror(ERROR_GENERIC)
+                keys = [(self.active_nxt, PORT_B), (self.active_nxt, PORT_C)]
+                self._start_move(keys, syncmotors.turn, power, int(turns*360))
+                if wait:
+                    self._wait_moves(keys)
             else:
                 raise logoerror(ERROR_POWER)
         else:
@@ -365,17 +422,25 @@ class Nxt_plugin(Plugin):
         if self._bricks:
             if not((power < -127) or (power > 127)):
                 try:
-                    motorB = Motor(self._bricks[self.active_nxt], PORT_B)
-                    motorC = Motor(self._bricks[self.active_nxt], PORT_C)
+                    motorB = self._get_motor(PORT_B)
+                    motorC = self._get_motor(PORT_C)
                     syncmotors = SynchronizedMotors(motorB, motorC, 0)
                     syncmotors.run(power)
+                    # the motors stay synced on the brick, but later blocks
+                    # drive them one by one again
+                    motorB.sync = motorC.sync = False
                 except:
+                    self._forget_motor(PORT_B)
+                    self._forget_motor(PORT_C)
                     raise logoerror(ERROR_GENERIC)
             else:
                 raise logoerror(ERROR_POWER)
         else:
             raise logoerror(ERROR_BRICK)
 
+    def waitmotors(self):
+        self._wait_moves()
+
     def playtone(self, freq, time):
         if self._bricks:
             try:
@@ -394,10 +459,10 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Light(self._bricks[self.active_nxt], port_aux)
-                    sensor.set_illuminated(False)
+                    sensor = self._get_sensor(port_aux, Light, False)
                     return sensor.get_lightness()
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -413,9 +478,10 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Light(self._bricks[self.active_nxt], port_aux)
+                    sensor = self._get_sensor(port_aux, Light)
                     return sensor.get_lightness()
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -431,10 +497,10 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Light(self._bricks[self.active_nxt], port_aux)
-                    sensor.set_illuminated(True)
+                    sensor = self._get_sensor(port_aux, Light, True)
                     return sensor.get_lightness()
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -450,12 +516,13 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Touch(self._bricks[self.active_nxt], port_aux)
+                    sensor = self._get_sensor(port_aux, Touch)
                     if sensor.get_sample():
                         return 1
                     else:
                         return 0
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -471,9 +538,10 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = HTCompass(self._bricks[self.active_nxt], port_aux)
+                    sensor = self._get_sensor(port_aux, HTCompass)
                     return sensor.get_heading()
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -489,9 +557,10 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Ultrasonic(self._bricks[self.active_nxt], port_aux)
+                    sensor = self._get_sensor(port_aux, Ultrasonic)
                     return sensor.get_sample()
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -507,9 +576,11 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Color20(self._bricks[self.active_nxt], port_aux)
-                    return colors[sensor.get_sample()]
+                    sensor = self._get_sensor(port_aux, Color20,
+                                              Type.COLORFULL)
+                    return colors[sensor.get_input_values().scaled_value]
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -525,9 +596,10 @@ class Nxt_plugin(Plugin):
             if (port in NXT_SENSOR_PORTS):
                 try:
                     port_aux = NXT_SENSOR_PORTS[port]
-                    sensor = Sound(self._bricks[self.active_nxt], port_aux)
+                    sensor = self._get_sensor(port_aux, Sound)
                     return sensor.get_sample()
                 except:
+                    self._forget_sensor(port_aux)
                     return ERROR
             else:
                 raise logoerror(ERROR_PORT_S % port)
@@ -542,9 +614,10 @@ class Nxt_plugin(Plugin):
                 port = NXT_MOTOR_PORTS[port_up]
                 if not((power < -127) or (power > 127)):
                     try:
-                        m = Motor(self._bricks[self.active_nxt], port)
+                        m = self._get_motor(port)
                         m.weak_turn(power, 0)
                     except:
+                        self._forget_motor(port)
                         raise logoerror(ERROR_GENERIC)
                 else:
                     raise logoerror(ERROR_POWER)
@@ -560,9 +633,10 @@ class Nxt_plugin(Plugin):
             if (port_up in NXT_MOTOR_PORTS):
                 port = NXT_MOTOR_PORTS[port_up]
                 try:
-                    m = Motor(self._bricks[self.active_nxt], port)
+                    m = self._get_motor(port)
                     m.brake()
                 except:
+                    self._forget_motor(port)
                     raise logoerror(ERROR_GENERIC)
             else:
                 raise logoerror(ERROR_PORT_M % port)
@@ -588,7 +662,7 @@ class Nxt_plugin(Plugin):
                 else:
                     color = Type.COLORNONE
                 try:
-                    Color20(self._bricks[self.active_nxt], port_aux).set_light_color(color)
+                    self._get_sensor(port_aux, Color20, color)
                 except:
                     raise logoerror(ERROR_GENERIC)
             else:
@@ -603,11 +677,12 @@ class Nxt_plugin(Plugin):
             if (port_up in NXT_MOTOR_PORTS):
                 port = NXT_MOTOR_PORTS[port_up]
                 try:
-                    m = Motor(self._bricks[self.active_nxt], port)
+                    m = self._get_motor(port)
                     t = m.get_tacho()
                     self._motor_pos[port_up][self.active_nxt] = t.tacho_count
                     m.idle()
                 except:
+                    self._forget_motor(port)
                     raise logoerror(ERROR_GENERIC)
             else:
                 raise logoerror(ERROR_PORT_M % port)
@@ -621,11 +696,12 @@ class Nxt_plugin(Plugin):
             if (port_up in NXT_MOTOR_PORTS):
                 port = NXT_MOTOR_PORTS[port_up]
                 try:
-                    m = Motor(self._bricks[self.active_nxt], port)
+                    m = self._get_motor(port)
                     t = m.get_tacho()
                     previous = self._motor_pos[port_up][self.active_nxt]
                     return (t.tacho_count - previous)
                 except:
+                    self._forget_motor(port)
                     raise logoerror(ERROR_GENERIC)
             else:
                 raise logoerror(ERROR_PORT_M % port)
@@ -709,16 +785,128 @@ class Nxt_plugin(Plugin):
             except:
                 pass
         self._bricks = []
+        self._sensors = {}
+        self._motors = {}
+        self._cancel_moves()
         self.active_nxt = 0
 
-    def _idle_motors(self):
-        for b in self._bricks:
+    def _get_sensor(self, port, sensor_class, mode=None):
+        """Returns a sensor_class object for the port of the active brick.
+        The object is reused by later calls, so the port is only set up again
+        when it is asked for with another class or mode (the illumination of
+        a Light, the light color of a Color20).
+        """
+        key = (self.active_nxt, port)
+        sensor, current_mode = self._sensors.get(key, (None, None))
+        if type(sensor) is not sensor_class:
+            sensor = sensor_class(self._bricks[self.active_nxt], port)
+            current_mode = None
+            if sensor_class is Color20:
+                current_mode = Type.COLORFULL
+        if mode is not None and mode != current_mode:
+            if sensor_class is Light:
+                sensor.set_illuminated(mode)
+            elif sensor_class is Color20:
+                sensor.set_light_color(mode)
+            current_mode = mode
+        self._sensors[key] = (sensor, current_mode)
+        return sensor
+
+    def _forget_sensor(self, port):
+        # after an error, set the port up again on the next use
+        self._sensors.pop((self.active_nxt, port), None)
+
+    def _get_motor(self, port, brick_index=None):
+        """Returns the Motor object for the port of a brick (the active one by
+        default). The object is kept and keeps track of the output state it
+        last set, so it only reads the state from the brick once.
+        """
+        if brick_index is None:
+            brick_index = self.active_nxt
+        key = (brick_index, port)
+        motor = self._motors.get(key)
+        if motor is None:
+            motor = Motor(self._bricks[brick_index], port)
+            self._motors[key] = motor
+        return motor
+
+    def _forget_motor(self, port):
+        # after an error, read the state from the brick again on the next use
+        self._motors.pop((self.active_nxt, port), None)
+
+    def _turn(self, motor, power, tacho_units, cancel):
+        motor.turn(power, tacho_units, brake=True, cancel=cancel)
+        if not cancel.is_set():
+            motor.brake()
+
+    def _start_move(self, keys, func, *args):
+        """Runs func(*args, cancel=event) in a new thread, once the moves
+        running on the motors of keys (brick index, port) have finished.
+        event is set when the moves are cancelled by stop(); a move which
+        was cancelled before it started doesn't run at all. Returns a
+        Future which waitmotors and _wait_moves look at.
+        """
+        previous = [self._moves[key] for key in keys if key in self._moves]
+        cancel = self._cancel
+        move = Future()
+        def run():
+            for other in previous:
+                other.exception()
+            if cancel.is_set():
+                move.set_result(None)
+                return
             try:
-                Motor(b, PORT_A).idle()
-                Motor(b, PORT_B).idle()
-                Motor(b, PORT_C).idle()
-            except:
-                pass
+                move.set_result(func(cancel=cancel, *args))
+            except Exception, err:
+                move.set_exception(err)
+        thread = Thread(target=run, name='nxt-plugin-move')
+        thread.daemon = True
+        thread.start()
+        for key in keys:
+            self._moves[key] = move
+        return move
+
+    def _wait_moves(self, keys=None):
+        """Waits for the moves started on the motors of keys (all of them by
+        default) and raises a logo error if any of them failed.
+        """
+        if keys is None:
+            keys = self._moves.keys()
+        failed = False
+        for key in keys:
+            move = self._moves.pop(key, None)
+            if move is not None and move.exception() is not None:
+                # read the state from the brick again on the next use
+                self._motors.pop(key, None)
+                failed = True
+        if failed:
+            raise logoerror(ERROR_GENERIC)
+
+    def _cancel_moves(self):
+        # stop the polling of running moves and keep chained ones from
+        # starting, then wait for them (up to MOVE_STOP_TIMEOUT seconds
+        # each) so that none brakes or starts a motor after the motors are
+        # idled; waiting for the last move of a motor covers the ones it
+        # was chained on
+        cancel, self._cancel = self._cancel, Event()
+        moves, self._moves = self._moves, {}
+        cancel.set()
+        for move in set(moves.values()):
+            try:
+                move.exception(MOVE_STOP_TIMEOUT)
+            except TimeoutError:
+                pass # abandoned; the motors are idled regardless
+
+    def _idle_motors(self):
+        # one telegram per brick stops all of its motors, and all bricks
+        # are told at once
+        results, errors = broadcast(self._bricks, 'set_output_state',
+            PORT_ALL, 0, MODE_IDLE, REGULATION_IDLE, 0, RUN_STATE_IDLE, 0)
+        # the Motor objects don't know about the broadcast (and the bricks
+        # which failed are in an unknown state), so read the state from the
+        # bricks again on the next use
+        self._motors = {}
+        return errors
 
     def _reset_motors_pos(self):
         self._motor_pos['A'] = []
@@ -0,0 +1,218 @@
+# Tests of the BrickLock and the IOThread, on a simulated brick
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import time
+import unittest
+from threading import Thread
+
+from nxt.error import FileNotFound
+from nxt.instrument import BrickLock, URGENT, NORMAL, BULK
+from nxt.motor import PORT_A, PORT_B, PORT_ALL, MODE_IDLE, MODE_MOTOR_ON, \
+    REGULATION_IDLE, RUN_STATE_IDLE, RUN_STATE_RUNNING
+from nxt.simsock import SimSock
+
+
+def _wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.001)
+
+
+def _run(power):
+    return (power, MODE_MOTOR_ON, REGULATION_IDLE, 0, RUN_STATE_RUNNING, 0)
+
+STOP = (0, MODE_IDLE, REGULATION_IDLE, 0, RUN_STATE_IDLE, 0)
+
+
+class BrickLockTest(unittest.TestCase):
+
+    def _acquire_order(self, lock, priorities):
+        order = []
+        def take(n, priority):
+            with lock.hold('t%d' % n, priority):
+                order.append(n)
+        lock.acquire()
+        threads = []
+        for n, priority in enumerate(priorities):
+            thread = Thread(target=take, args=(n, priority))
+            thread.start()
+            threads.append(thread)
+            # queue the waiters in a known order
+            _wait_for(lambda: lock.waiting() == n + 1)
+        lock.release()
+        for thread in threads:
+            thread.join()
+        return order
+
+    def test_priority_order(self):
+        lock = BrickLock()
+        order = self._acquire_order(lock, [NORMAL, BULK, URGENT, NORMAL])
+        self.assertEqual(order, [2, 0, 3, 1])
+        stats = lock.stats()
+        self.assertEqual(stats['contended'], 4)
+        self.assertTrue(stats['jumps'] >= 1)
+        self.assertEqual(stats['holds']['t2']['count'], 1)
+
+    def test_fifo_without_priorities(self):
+        lock = BrickLock(priority_aware=False)
+        order = self._acquire_order(lock, [NORMAL, BULK, URGENT, NORMAL])
+        self.assertEqual(order, [0, 1, 2, 3])
+        self.assertEqual(lock.stats()['jumps'], 0)
+
+    def test_release_unlocked(self):
+        self.assertRaises(RuntimeError, BrickLock().release)
+
+    def test_non_blocking(self):
+        lock = BrickLock()
+        self.assertTrue(lock.acquire(False))
+        results = []
+        thread = Thread(target=lambda: results.append(lock.acquire(False)))
+        thread.start()
+        thread.join(1)
+        self.assertEqual(results, [False])
+        self.assertEqual(lock.waiting(), 0)
+        lock.release()
+
+    def test_waits_by_name(self):
+        lock = BrickLock()
+        def poll():
+            with lock.hold('poll'):
+                pass
+        for n in range(20):
+            thread = Thread(target=poll) # a new thread name every time
+            thread.start()
+            thread.join()
+        self.assertEqual(lock.stats()['waits'].keys(), ['poll'])
+        self.assertEqual(lock.stats()['waits']['poll']['count'], 20)
+
+
+class IOThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.brick = SimSock('instant', seed=0).connect()
+        self.sent = []
+        send = self.brick.sock.send
+        def record(data):
+            self.sent.append(data)
+            send(data)
+        self.brick.sock.send = record
+        self.io = self.brick.start_io_thread()
+
+    def tearDown(self):
+        self.brick.stop_io_thread()
+
+    def _hold_link(self):
+        """Takes the brick lock, and lets the IOThread take one command off
+        its queue, so that the commands submitted next stay queued until
+        the lock is released.
+        """
+        self.brick.lock.acquire()
+        self.io.keep_alive()
+        _wait_for(lambda: self.io.pending() == 0)
+        del self.sent[:]
+
+    def _sent_opcodes(self):
+        return [ord(pkt[1]) for pkt in self.sent]
+
+    def test_futures(self):
+        self.assertEqual(self.io.get_battery_level().result(1), 7800)
+        self.assertEqual(self.brick.get_battery_level(), 7800)
+        future = self.io.open_read('missing.txt')
+        self.assertTrue(isinstance(future.exception(1), FileNotFound))
+
+    def test_coalesce_per_port(self):
+        self._hold_link()
+        futures = [self.io.set_output_state(PORT_A, *_run(10)),
+                   self.io.set_output_state(PORT_B, *_run(30)),
+                   self.io.set_output_state(PORT_A, *_run(20))]
+        self.assertEqual(self.io.pending(), 2)
+        self.brick.lock.release()
+        for future in futures:
+            self.assertEqual(future.result(1), None)
+        sent = self.sent[1:] # after the keep_alive
+        self.assertEqual([(ord(pkt[2]), ord(pkt[3])) for pkt in sent],
+                         [(PORT_B, 30), (PORT_A, 20)])
+        self.assertEqual(self.io.stats()['coalesced'], 1)
+        self.assertEqual(self.brick.get_output_state(PORT_A)[1], 20)
+
+    def test_port_all_supersedes(self):
+        self._hold_link()
+        futures = [self.io.set_output_state(PORT_A, *_run(10)),
+                   self.io.set_output_state(PORT_B, *_run(30)),
+                   self.io.set_output_state(PORT_ALL, *STOP)]
+        self.assertEqual(self.io.pending(), 1)
+        self.brick.lock.release()
+        for future in futures:
+            self.assertEqual(future.result(1), None)
+        self.assertEqual([ord(pkt[2]) for pkt in self.sent[1:]], [PORT_ALL])
+        self.assertEqual(self.io.stats()['coalesced'], 2)
+
+    def test_priority(self):
+        self._hold_link()
+        futures = [self.io.get_battery_level(priority=BULK),
+                   self.io.get_battery_level(),
+                   self.io.set_output_state(PORT_A, *_run(40)),
+                   self.io.set_output_state(PORT_B, *STOP)]
+        self.brick.lock.release()
+        for future in futures:
+            future.result(1)
+        # the stop first, then the NORMAL commands in order, then BULK
+        self.assertEqual(self._sent_opcodes()[1:], [0x04, 0x0B, 0x04, 0x0B])
+        self.assertEqual(ord(self.sent[1][2]), PORT_B)
+
+    def test_batch_keeps_its_order(self):
+        self._hold_link()
+        batch = self.brick.batch()
+        batch.get_output_state(PORT_A)
+        batch.set_output_state(PORT_A, *STOP)
+        batch.get_battery_level()
+        thread = Thread(target=batch.execute)
+        thread.start()
+        _wait_for(lambda: self.io.pending() == 3)
+        self.io.set_output_state(PORT_B, *_run(50))
+        self.brick.lock.release()
+        thread.join()
+        # the batch holds a stop, so it goes first, but in its own order
+        self.assertEqual(self._sent_opcodes()[1:], [0x06, 0x04, 0x0B, 0x04])
+        self.assertEqual(len(batch.results), 3)
+
+
+class BatchResyncTest(unittest.TestCase):
+
+    def _check(self, brick):
+        batch = brick.batch()
+        batch.get_battery_level()
+        batch.open_read('missing.txt')
+        batch.get_battery_level()
+        self.assertRaises(FileNotFound, batch.execute)
+        self.assertEqual(batch.results[0], 7800)
+        self.assertTrue(isinstance(batch.results[1], FileNotFound))
+        self.assertEqual(batch.results[2], 7800)
+        # every reply was read, so the next command gets its own
+        self.assertEqual(brick.get_output_state(PORT_A)[0], PORT_A)
+
+    def test_direct(self):
+        self._check(SimSock('usb', seed=0).connect())
+
+    def test_io_thread(self):
+        brick = SimSock('usb', seed=0).connect()
+        brick.start_io_thread()
+        try:
+            self._check(brick)
+        finally:
+            brick.stop_io_thread()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+# Tests which run nxt-python against simulated bricks (see nxt.simsock)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import unittest
+
+import nxt.locator
+import nxt.sensor.digital
+from nxt.mailbox import pack, Unpacker, MAX_MESSAGE, MORE
+from nxt.motor import Motor, PORT_A
+from nxt.sensor import PORT_1, PORT_2
+from nxt.sensor.digital import BaseDigitalSensor, LSStats, I2CError
+from nxt.simsock import SimSock, SimBrick, SimI2CDevice
+from nxt.usbsock import USBSock
+
+
+class MailboxFormatTest(unittest.TestCase):
+
+    def _round_trip(self, payloads):
+        messages = pack(payloads)
+        for message in messages:
+            self.assertTrue(0 < len(message) <= MAX_MESSAGE)
+            self.assertNotEqual(message[0], '\0')
+        unpacker = Unpacker()
+        received = []
+        for message in messages:
+            received.extend(unpacker.feed(message))
+        self.assertEqual(received, payloads)
+        return messages
+
+    def test_small_payloads_share_a_message(self):
+        messages = self._round_trip(['a', 'bc', '', 'def'])
+        self.assertEqual(messages, ['\x02a\x03bc\x01\x04def'])
+
+    def test_large_payload_is_split(self):
+        payload = ''.join(chr(n % 256) for n in range(300))
+        messages = self._round_trip([payload])
+        self.assertTrue(len(messages) > 1)
+        self.assertTrue(ord(messages[0][0]) & MORE)
+
+    def test_mixed(self):
+        self._round_trip(['x' * 57, 'y', 'z' * 120, '\0\0', 'end'])
+
+    def test_terminator(self):
+        self.assertEqual(Unpacker().feed('\x02a\x00garbage'), ['a'])
+
+    def test_channel_echo(self):
+        from nxt.mailbox import MailboxChannel
+        brick = SimSock('instant').connect()
+        sim = brick.sock.sim
+        # a program on the brick which echoes inbox 0 to inbox 10
+        def echo():
+            while sim.mailboxes[0]:
+                sim.mailboxes[10].append(sim.mailboxes[0].popleft())
+        channel = MailboxChannel(brick)
+        channel.send('hello', flush=False)
+        channel.send('x' * 100)
+        echo()
+        channel.poll()
+        self.assertEqual(channel.recv(1), 'hello')
+        self.assertEqual(channel.recv(1), 'x' * 100)
+
+
+class BurstPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        brick = SimSock('instant').connect()
+        brick.sock.sim.add_i2c_device(PORT_1, SimI2CDevice('V1.23',
+            'Vendor', 'Thing'))
+        self.sensor = BaseDigitalSensor(brick, PORT_1, False)
+
+    def test_neighbours_share_a_read(self):
+        plan = self.sensor._plan_burst(('version', 'product_id',
+                                        'sensor_type'))
+        self.assertEqual(plan, [
+            (0x00, 16, [('version', 0, '8s'), ('product_id', 8, '8s')]),
+            (0x10, 8, [('sensor_type', 0, '8s')])])
+
+    def test_single_bytes(self):
+        plan = self.sensor._plan_burst(('factory_scale_divisor',
+                                        'factory_scale_factor'))
+        self.assertEqual(plan, [(0x12, 2, [('factory_scale_factor', 0, 'B'),
+                                           ('factory_scale_divisor', 1, 'B')])])
+
+    def test_duplicates(self):
+        self.assertEqual(self.sensor._plan_burst(('version', 'version')),
+                         [(0x00, 8, [('version', 0, '8s')])])
+
+    def test_read_values(self):
+        version, product_id = self.sensor.read_values('version', 'product_id')
+        self.assertEqual(version[0].rstrip('\0'), 'V1.23')
+        self.assertEqual(product_id[0].rstrip('\0'), 'Vendor')
+
+
+class LSStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        brick = SimSock('instant').connect()
+        brick.sock.sim.add_i2c_device(PORT_2)
+        self.sensor = BaseDigitalSensor(brick, PORT_2, False)
+        self.delays = []
+        self._sleep = nxt.sensor.digital.sleep
+        nxt.sensor.digital.sleep = self.delays.append
+
+    def tearDown(self):
+        nxt.sensor.digital.sleep = self._sleep
+
+    def _answer_after(self, n_polls, n_bytes):
+        polls = []
+        def ls_get_status(port):
+            polls.append(port)
+            return n_bytes if len(polls) >= n_polls else 0
+        self.sensor.brick.ls_get_status = ls_get_status
+
+    def test_backoff(self):
+        stats = self.sensor.get_ls_stats()
+        first = stats.estimate(8)
+        self._answer_after(5, 8)
+        self.assertEqual(self.sensor._ls_get_status(8), 8)
+        expected = [first]
+        for n in range(4):
+            expected.append(min(max(expected[-1], LSStats.MIN_BACKOFF) * 2,
+                                LSStats.MAX_BACKOFF))
+        self.assertEqual(self.delays, expected)
+        self.assertEqual(max(self.delays), LSStats.MAX_BACKOFF)
+        self.assertEqual((stats.transactions, stats.status_polls), (1, 5))
+
+    def test_timeout(self):
+        self._answer_after(1000, 8)
+        self.assertRaises(I2CError, self.sensor._ls_get_status, 8)
+        self.assertEqual(len(self.delays), 30)
+        self.assertEqual(self.sensor.get_ls_stats().timeouts, 1)
+
+    def test_learning(self):
+        stats = LSStats()
+        stats.record(8, 1, 1)
+        self.assertAlmostEqual(stats.byte_time, LSStats.BYTE_TIME * 0.9)
+        stats = LSStats()
+        stats.record(8, 0.033, 3)
+        self.assertAlmostEqual(stats.byte_time,
+                               (LSStats.BYTE_TIME + 0.033 / 11) / 2)
+        self.assertEqual(stats.estimate(0), stats.byte_time * 3)
+
+    def test_shared_per_port(self):
+        self.assertTrue(self.sensor.get_ls_stats() is
+                        self.sensor.brick.ls_stats[PORT_2])
+
+
+class LimitedTurnTest(unittest.TestCase):
+
+    def _count_polls(self, brick):
+        polls = []
+        get_output_state = brick.get_output_state
+        def count(port):
+            polls.append(port)
+            return get_output_state(port)
+        brick.get_output_state = count
+        return polls
+
+    def _check(self, profile):
+        for power, tacho_units in ((100, 360), (-60, 180)):
+            brick = SimSock(profile, seed=0).connect()
+            motor = Motor(brick, PORT_A)
+            polls = self._count_polls(brick)
+            motor.limited_turn(power, tacho_units)
+            self.assertEqual(abs(motor.get_tacho().tacho_count), tacho_units)
+            # the first read, about three polls while turning, the last read
+            self.assertTrue(len(polls) <= 6, polls)
+
+    def test_usb_polls(self):
+        self._check('usb')
+
+    def test_bluetooth_polls(self):
+        self._check('bluetooth')
+
+    def test_arguments(self):
+        motor = Motor(SimSock('instant').connect(), PORT_A)
+        self.assertRaises(ValueError, motor.limited_turn, 0, 360)
+        self.assertRaises(ValueError, motor.limited_turn, 50, 0)
+
+
+class _USBDevice(object):
+    'Has only the attributes of a usb.core.Device which USBSock names'
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+
+class _SimUSBSock(USBSock):
+    'A USBSock which connects to a simulated brick'
+    def __init__(self, device, sim):
+        USBSock.__init__(self, device)
+        self.sim = sim
+
+    def connect(self):
+        return SimSock('usb', self.sim).connect()
+
+
+class ParallelSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self._backends = nxt.locator._backends
+        self.sims = [SimBrick('NXT%d' % n, '00:16:53:00:00:0%d' % n)
+                     for n in range(3)]
+
+    def tearDown(self):
+        nxt.locator._backends = self._backends
+
+    def _use(self, *searches):
+        nxt.locator._backends = lambda method: [
+            ('Sim%d' % n, search) for n, search in enumerate(searches)]
+
+    def _sim_search(self, sims):
+        return lambda host, name, method: [SimSock('usb', sim) for sim in sims]
+
+    def test_finds_all(self):
+        self._use(self._sim_search(self.sims[:2]),
+                  self._sim_search(self.sims[2:]))
+        bricks = nxt.locator.find_all_bricks_parallel(silent=True)
+        self.assertEqual(len(bricks), 6) # by name and by address
+        for sim in self.sims:
+            self.assertTrue(bricks[sim.name] is bricks[sim.address])
+            self.assertTrue(bricks[sim.name].sock.sim is sim)
+
+    def test_usb_candidates(self):
+        sock = _SimUSBSock(_USBDevice(1, 7), self.sims[0])
+        self.assertEqual(str(sock), 'USB (bus 1, address 7)')
+        self._use(lambda host, name, method: [sock])
+        bricks = nxt.locator.find_all_bricks_parallel(silent=True)
+        self.assertEqual(sorted(bricks), ['00:16:53:00:00:00', 'NXT0'])
+
+    def test_name_filter(self):
+        self._use(self._sim_search(self.sims))
+        bricks = nxt.locator.find_all_bricks_parallel(name='NXT1',
+                                                      silent=True)
+        self.assertEqual(sorted(bricks), ['00:16:53:00:00:01', 'NXT1'])
+
+    def test_unavailable_backend(self):
+        def missing(host, name, method):
+            raise ImportError('no such backend')
+        self._use(missing, self._sim_search(self.sims[:1]))
+        bricks = nxt.locator.find_all_bricks_parallel(silent=True)
+        self.assertEqual(sorted(bricks), ['00:16:53:00:00:00', 'NXT0'])
+        self._use(missing)
+        self.assertRaises(nxt.locator.NoBackendError,
+                          nxt.locator.find_all_bricks_parallel, silent=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
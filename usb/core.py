@@ -40,8 +40,8 @@ show_devices() - a function to show the devices present.
 
 __author__ = 'Wander Lairson Costa'
 
-__all__ = [ 'Device', 'Configuration', 'Interface', 'Endpoint', 'find',
-            'show_devices' ]
+__all__ = [ 'Device', 'Configuration', 'Interface', 'Endpoint',
+            'BoundEndpoint', 'find', 'show_devices' ]
 
 import usb.util as util
 import copy
@@ -378,6 +378,71 @@ class Endpoint(object):
             _lu.ep_attributes[(self.bmAttributes & 0x3)],
             direction))
 
+class BoundEndpoint(object):
+    r"""Fast path for repeated transfers on a single endpoint.
+
+    Objects of this class are returned by Device.bind_endpoint(). The
+    backend transfer function, the interface number and the endpoint
+    address are resolved once, when the object is created, so read_into()
+    and write() go straight to the backend.
+
+    The object is only valid for the configuration which was active when it
+    was created. After setting another configuration, resetting or disposing
+    the device, bind the endpoint again.
+    """
+    def __init__(self, device, endpoint):
+        ctx = device._ctx
+        intf, ep = ctx.setup_request(device, endpoint)
+        backend = ctx.backend
+
+        if util.endpoint_direction(ep.bEndpointAddress) == util.ENDPOINT_IN:
+            fn_map = {
+                        util.ENDPOINT_TYPE_BULK:backend.bulk_read,
+                        util.ENDPOINT_TYPE_INTR:backend.intr_read,
+                        util.ENDPOINT_TYPE_ISO:backend.iso_read
+                    }
+        else:
+            fn_map = {
+                        util.ENDPOINT_TYPE_BULK:backend.bulk_write,
+                        util.ENDPOINT_TYPE_INTR:backend.intr_write,
+                        util.ENDPOINT_TYPE_ISO:backend.iso_write
+                    }
+
+        self._fn = fn_map[util.endpoint_type(ep.bmAttributes)]
+        self._handle = ctx.handle
+        self._intf = intf.bInterfaceNumber
+        self.bEndpointAddress = ep.bEndpointAddress
+        self.timeout = device.default_timeout
+
+    def write(self, data, timeout = None):
+        r"""Write data to an OUT endpoint.
+
+        The data parameter should be an array object or a sequence like type
+        convertible to it. If timeout is omitted, the device default timeout
+        at the time the endpoint was bound is used.
+
+        The method returns the number of bytes written.
+        """
+        if not isinstance(data, array.array):
+            data = _interop.as_array(data)
+        if timeout is None:
+            timeout = self.timeout
+        return self._fn(self._handle, self.bEndpointAddress, self._intf,
+                        data, timeout)
+
+    def read_into(self, buff, timeout = None):
+        r"""Read data from an IN endpoint into the array object buff.
+
+        If timeout is omitted, the device default timeout at the time the
+        endpoint was bound is used.
+
+        The method returns the number of bytes actually read.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return self._fn(self._handle, self.bEndpointAddress, self._intf,
+                        buff, timeout)
+
 class Interface(object):
     r"""Represent an interface object.
 
@@ -924,6 +989,15 @@ class Device(object):
         else:
             return buff
 
+    def bind_endpoint(self, endpoint):
+        r"""Return a BoundEndpoint for fast repeated transfers.
+
+        The endpoint parameter is either an Endpoint object or the
+        bEndpointAddress of the endpoint. The interface it belongs to is
+        claimed right away. See the BoundEndpoint class for details.
+        """
+        return BoundEndpoint(self, endpoint)
+
     def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
             data_or_wLength = None, timeout = None):
         r"""Do a control transfer on the endpoint 0.